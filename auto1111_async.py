@@ -0,0 +1,142 @@
+import asyncio
+
+import httpx
+
+from auto1111_if import (DEFAULT_BASE_URL, adding_hair_modification_payload, color_modification_payload,
+                         decode_result_image, shape_modification_payload)
+
+
+class AsyncAuto1111Client:
+    """
+    Asyncio client for the Automatic1111 web UI API, so waiting for a diffusion job does not pin a worker thread.
+    All calls share one pooled keep-alive httpx.AsyncClient.
+
+    Example usage:
+        client = AsyncAuto1111Client("http://127.0.0.1:7860")
+        job = asyncio.create_task(client.img2img(payload))
+        async for progress in client.stream_progress(until=job):
+            print(progress)
+        result = await job
+    """
+    def __init__(self, base_url=DEFAULT_BASE_URL, timeout=600, connect_timeout=5, progress_timeout=5, retries=3,
+                 max_connections=8):
+        """
+        :param base_url: Base URL of the Automatic1111 server.
+        :param timeout: Read timeout in seconds of img2img requests.
+        :param connect_timeout: Connect timeout in seconds.
+        :param progress_timeout: Timeout in seconds of progress and interrupt requests.
+        :param retries: Number of retries when the connection cannot be established.
+        :param max_connections: Maximum number of connections kept to the server.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.progress_timeout = progress_timeout
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            transport=httpx.AsyncHTTPTransport(retries=retries),
+        )
+
+    async def img2img(self, payload):
+        response = await self.client.post("/sdapi/v1/img2img", json=payload)
+        return response.json()
+
+    async def get_progress(self):
+        r = await self.client.get("/sdapi/v1/progress", timeout=self.progress_timeout)
+        data = r.json()
+        return int(data['progress'] * 100)
+
+    async def stream_progress(self, interval=1.0, until=None):
+        """
+        Async generator yielding the backend progress every interval seconds, until the given task is done
+        (or forever if until is None).
+        """
+        while until is None or not until.done():
+            yield await self.get_progress()
+            if until is None:
+                await asyncio.sleep(interval)
+            else:
+                await asyncio.wait([until], timeout=interval)
+
+    async def interrupt(self):
+        return await self.client.post("/sdapi/v1/interrupt", timeout=self.progress_timeout)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class AsyncJobSubmitter:
+    """
+    Shares one or more backends between many UI sessions: at most max_concurrent img2img jobs are in flight,
+    each one sent to the backend with the fewest outstanding jobs. A1111 renders one request at a time and its
+    interrupt stops whichever one it is rendering, so each backend gets one request at a time and the other jobs
+    wait here. A job whose awaiting task is cancelled interrupts its backend only if it is the one rendering.
+
+    Example usage:
+        submitter = AsyncJobSubmitter([AsyncAuto1111Client()], max_concurrent=2)
+        image = await color_modification_async(source, mask, "Ash Blonde", submitter)
+    """
+    def __init__(self, clients, max_concurrent=None):
+        """
+        :param clients: AsyncAuto1111Client instances, one per backend.
+        :param max_concurrent: Maximum number of jobs in flight, one per backend if None.
+        """
+        self.clients = list(clients)
+        self._semaphore = asyncio.Semaphore(max_concurrent or len(self.clients))
+        self._outstanding = {client: 0 for client in self.clients}
+        self._backend_locks = {client: asyncio.Lock() for client in self.clients}
+
+    async def submit(self, payload):
+        async with self._semaphore:
+            client = min(self.clients, key=lambda c: self._outstanding[c])
+            self._outstanding[client] += 1
+            try:
+                # Cancelled while waiting for the backend: nothing was sent, nothing to interrupt
+                async with self._backend_locks[client]:
+                    try:
+                        return await client.img2img(payload)
+                    except asyncio.CancelledError:
+                        # Stop the backend job we started, nobody is waiting for its result anymore. The backend
+                        # is still held, so the next job is not sent before the interrupt
+                        await asyncio.shield(client.interrupt())
+                        raise
+            finally:
+                self._outstanding[client] -= 1
+
+    async def aclose(self):
+        for client in self.clients:
+            await client.aclose()
+
+
+async def _submit(submitter, payload_fn, *args):
+    # Encoding the images is CPU work, keep it off the event loop
+    payload = await asyncio.to_thread(payload_fn, *args)
+    result = await submitter.submit(payload)
+    return await asyncio.to_thread(decode_result_image, result)
+
+
+async def shape_modification_async(source_image, reference_shape_image, inpaint_mask_bw_image, submitter,
+                                   resolution=(512, 512)):
+    """
+    Awaitable variant of auto1111_if.shape_modification, sent through an AsyncJobSubmitter.
+    """
+    return await _submit(submitter, shape_modification_payload,
+                         source_image, reference_shape_image, inpaint_mask_bw_image, resolution)
+
+
+async def adding_hair_modification_async(source_image, reference_hair_image, inpaint_mask_bw_image, submitter,
+                                         resolution=(512, 512)):
+    """
+    Awaitable variant of auto1111_if.adding_hair_modification, sent through an AsyncJobSubmitter.
+    """
+    return await _submit(submitter, adding_hair_modification_payload,
+                         source_image, reference_hair_image, inpaint_mask_bw_image, resolution)
+
+
+async def color_modification_async(source_image, inpaint_mask_bw_image, color_text, submitter,
+                                   resolution=(512, 512), seed=-1):
+    """
+    Awaitable variant of auto1111_if.color_modification, sent through an AsyncJobSubmitter.
+    """
+    return await _submit(submitter, color_modification_payload,
+                         source_image, inpaint_mask_bw_image, color_text, resolution, seed)
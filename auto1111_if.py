@@ -1,25 +1,192 @@
 import requests
 import base64
+import threading
+import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from mask_compositing import feather_blend, mask_bbox, roi_box
+from progress_poller import ProgressPoller
 from vers_image import VersImage
 
+DEFAULT_BASE_URL = "http://127.0.0.1:7860"
+
+
+class Auto1111Client:
+    """
+    Client for the Automatic1111 web UI API. All calls share one requests.Session, so connections to the
+    backend are pooled and kept alive instead of being opened for every request and every progress poll.
+    Connection failures and 502/503/504 responses are retried with exponential backoff (img2img POSTs are only
+    retried when the connection could not be established, never after the request was sent).
+    A1111 renders one request at a time and /sdapi/v1/interrupt stops whichever one it is rendering, so the client
+    sends one img2img request at a time (the others wait on the client side), and the interrupt of a job is only
+    sent while that job holds the backend.
+    While img2img requests are in flight, one background thread polls the backend progress; get_progress returns
+    the latest polled value, so progress bars of any number of sessions cost no extra requests.
+
+    Example usage:
+        client = Auto1111Client("http://127.0.0.1:7860")
+        result = client.img2img(payload)
+        print(client.get_progress())
+    """
+    def __init__(self, base_url=DEFAULT_BASE_URL, timeout=(5, 600), progress_timeout=5, retries=3,
+                 backoff_factor=0.5, pool_maxsize=8, progress_interval=0.5):
+        """
+        :param base_url: Base URL of the Automatic1111 server.
+        :param timeout: (connect, read) timeout in seconds of img2img requests.
+        :param progress_timeout: Timeout in seconds of progress and interrupt requests.
+        :param retries: Number of retries on connection errors and 502/503/504 responses.
+        :param backoff_factor: Exponential backoff factor between retries, in seconds.
+        :param pool_maxsize: Maximum number of connections kept alive to the server.
+        :param progress_interval: Seconds between progress polls while img2img requests are in flight.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.progress_timeout = progress_timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.progress_poller = ProgressPoller(self.fetch_progress, interval=progress_interval)
+        self._slot = threading.Condition()
+        self._busy = False  # An img2img request of this client is on the backend
+        self._holder = None  # Job of that request, if it was sent with one
+
+    def img2img(self, payload, job=None):
+        with self._slot:
+            if job is not None:
+                job.client = self
+            while self._busy and not (job is not None and job.interrupted):
+                self._slot.wait()
+            if job is not None and job.interrupted:  # Cancelled before it was sent
+                return {}
+            self._busy, self._holder = True, job
+        try:
+            with self.progress_poller.track():
+                response = self.session.post(f"{self.base_url}/sdapi/v1/img2img", json=payload,
+                                             timeout=self.timeout)
+        finally:
+            with self._slot:
+                self._busy, self._holder = False, None
+                self._slot.notify_all()
+        return response.json()
+
+    def get_progress(self, job=None):
+        """
+        Latest polled progress of the backend, 0 when no request of this client is in flight (or, for a job, while
+        the job waits for the backend).
+        """
+        if job is not None and self._holder is not job:
+            return 0
+        return self.progress_poller.progress
+
+    def fetch_progress(self):
+        """Request the progress from the backend (the live preview image is skipped)."""
+        r = self.session.get(f"{self.base_url}/sdapi/v1/progress", params={"skip_current_image": "true"},
+                             timeout=self.progress_timeout)
+        data = r.json()
+        return int(data['progress'] * 100)
+
+    def interrupt(self, job=None):
+        """
+        Interrupt the backend. For a job, only if it holds the backend: a job waiting for it is woken up to return
+        without being sent, and the request after a finished job is not stopped. The slot is held while the
+        interrupt is sent, so the next request cannot reach the backend before it.
+
+        :return: The response, or None if no interrupt was sent.
+        """
+        with self._slot:
+            if job is not None and self._holder is not job:
+                self._slot.notify_all()
+                return None
+            return self.session.post(f"{self.base_url}/sdapi/v1/interrupt", timeout=self.progress_timeout)
+
+    def close(self):
+        self.session.close()
+
+
+class Img2ImgJob:
+    """
+    Handle of an img2img request. The client that runs the request records itself on the job, so progress and
+    interrupt requests for the job are sent to the backend that owns it (see backend_pool.BackendPool).
+    A job interrupted before its request is sent (or while it waits for its backend) is never sent, and a job
+    interrupts its backend at most once, only while its request is the one being rendered.
+    """
+    def __init__(self):
+        self.client = None
+        self.interrupted = False
+
+    def get_progress(self):
+        return self.client.get_progress(job=self) if self.client is not None else 0
+
+    def interrupt(self):
+        if self.interrupted:  # Interrupt the backend once per job
+            return None
+        self.interrupted = True
+        return self.client.interrupt(job=self) if self.client is not None else None
+
+
+default_client = Auto1111Client()
+
+
+def set_default_client(client):
+    """
+    Replace the client used by the module functions when no client is passed (e.g. to change the base URL).
+    """
+    global default_client
+    default_client = client
+
+# Wire encodings of the images sent to the backend: name -> (PIL format, mode, save options)
+WIRE_FORMATS = {
+    "png": ("PNG", None, {}),
+    "png_fast": ("PNG", None, {"compress_level": 1}),  # Lossless, a few times faster to encode than the default level
+    "webp_lossless": ("WEBP", None, {"lossless": True, "quality": 0, "method": 0}),  # Fastest lossless WebP effort
+    "jpeg_preview": ("JPEG", "RGB", {"quality": 85}),  # Lossy, only for previews
+    "mask_1bit": ("PNG", "1", {}),  # Black and white masks packed as 1 bit per pixel
+}
+SOURCE_WIRE_FORMAT = "png_fast"
+MASK_WIRE_FORMAT = "mask_1bit"
+
 # encode image from vers_image class
-def encode_image(vimage : VersImage):
-    return base64.b64encode(vimage.to_streamio().getvalue()).decode()
+def encode_image(vimage : VersImage, wire_format = SOURCE_WIRE_FORMAT):
+    """
+    Base64 encode an image for the API. The encoded bytes are cached by the VersImage.
 
-def shape_modification(source_image, reference_shape_image, inpaint_mask_bw_image, resolution = (512,512)):
+    :param wire_format: Name of the encoding in WIRE_FORMATS.
     """
-    Modify the shape of the source image based on the reference shape image and inpaint mask.
+    format, mode, options = WIRE_FORMATS[wire_format]
+    return base64.b64encode(vimage.to_streamio(format, mode, **options).getvalue()).decode()
 
-    :param source_image: Path to the source image to be modified.
-    :param reference_shape_image: Path to the reference shape image.
-    :param inpaint_mask_image: Path to the inpaint mask image.
-    :param output_image_path: Path where the modified image will be saved.
+def decode_result_image(result):
+    """
+    Decode the first image of an img2img response, or None if the backend returned no image.
+    """
+    if 'images' not in result or len(result['images']) == 0:
+        return None
+    image_bytes = base64.b64decode(result['images'][0])
+    return VersImage.from_binary(image_bytes)
+
+def decode_result_images(result, count=None):
+    """
+    Decode the images of an img2img response, as a list of VersImage.
+
+    :param count: Number of rendered images to keep. ControlNet appends its detected maps after the rendered images,
+                  so a batch request should pass its batch_size.
+    """
+    images = result.get('images') or []
+    if count is not None:
+        images = images[:count]
+    return [VersImage.from_binary(base64.b64decode(image)) for image in images]
+
+def shape_modification_payload(source_image, reference_shape_image, inpaint_mask_bw_image, resolution = (512,512)):
+    """
+    Build the img2img payload of shape_modification.
     """
     # Encode images to base64
     source_image_b64 = encode_image(source_image.resize(resolution))
     reference_shape_b64 = encode_image(reference_shape_image.resize(resolution))
-    inpaint_mask_b64 = encode_image(inpaint_mask_bw_image.resize(resolution))
+    inpaint_mask_b64 = encode_image(inpaint_mask_bw_image.resize(resolution), MASK_WIRE_FORMAT)
     ip_adapter_image = source_image_b64
 
     # Create payload
@@ -83,19 +250,9 @@ def shape_modification(source_image, reference_shape_image, inpaint_mask_bw_imag
         }
     }
 
-    # Send request to the API
-    response = requests.post("http://127.0.0.1:7860/sdapi/v1/img2img", json=payload)
-    result = response.json()
-
-    # Save the output image
-    image_data = result['images'][0]
-    image_bytes = base64.b64decode(image_data)
-
-    vimage = VersImage.from_binary(image_bytes)
-    # vimage.image.show()
-    return vimage
+    return payload
 
-def adding_hair_modification(source_image, reference_hair_image, inpaint_mask_bw_image, resolution = (512,512)):
+def shape_modification(source_image, reference_shape_image, inpaint_mask_bw_image, resolution = (512,512), client=None, job=None):
     """
     Modify the shape of the source image based on the reference shape image and inpaint mask.
 
@@ -103,11 +260,26 @@ def adding_hair_modification(source_image, reference_hair_image, inpaint_mask_bw
     :param reference_shape_image: Path to the reference shape image.
     :param inpaint_mask_image: Path to the inpaint mask image.
     :param output_image_path: Path where the modified image will be saved.
+    :param client: Auto1111Client (or BackendPool) to send the request with, the module default client if None.
+    :param job: Optional Img2ImgJob, records the backend running the request.
+    """
+    payload = shape_modification_payload(source_image, reference_shape_image, inpaint_mask_bw_image, resolution)
+
+    # Send request to the API
+    result = (client or default_client).img2img(payload, job=job)
+
+    return decode_result_image(result)
+
+def adding_hair_modification_payload(source_image, reference_hair_image, inpaint_mask_bw_image, resolution = (512,512), reference_resolution = None):
+    """
+    Build the img2img payload of adding_hair_modification.
+
+    :param reference_resolution: Size the reference hair image is sent at, the resolution if None.
     """
     # Encode images to base64
     source_image_b64 = encode_image(source_image.resize(resolution))
-    reference_hair_b64 = encode_image(reference_hair_image.resize(resolution))
-    inpaint_mask_b64 = encode_image(inpaint_mask_bw_image.resize(resolution))
+    reference_hair_b64 = encode_image(reference_hair_image.resize(reference_resolution or resolution))
+    inpaint_mask_b64 = encode_image(inpaint_mask_bw_image.resize(resolution), MASK_WIRE_FORMAT)
     ip_adapter_image = source_image_b64
 
     # Create payload
@@ -155,21 +327,10 @@ def adding_hair_modification(source_image, reference_hair_image, inpaint_mask_bw
         }
     }
 
-    # Send request to the API
-    response = requests.post("http://127.0.0.1:7860/sdapi/v1/img2img", json=payload)
-    result = response.json()
-
-    # Save the output image
-    image_data = result['images'][0]
-    image_bytes = base64.b64decode(image_data)
-
-    vimage = VersImage.from_binary(image_bytes)
-    # vimage.image.show()
-    return vimage
+    return payload
 
-
-
-def color_modification(source_image, inpaint_mask_bw_image, color_text, resolution = (512,512)):
+def adding_hair_modification(source_image, reference_hair_image, inpaint_mask_bw_image, resolution = (512,512), client=None, job=None, roi=False,
+                             reference_resolution=None):
     """
     Modify the shape of the source image based on the reference shape image and inpaint mask.
 
@@ -177,11 +338,39 @@ def color_modification(source_image, inpaint_mask_bw_image, color_text, resoluti
     :param reference_shape_image: Path to the reference shape image.
     :param inpaint_mask_image: Path to the inpaint mask image.
     :param output_image_path: Path where the modified image will be saved.
+    :param client: Auto1111Client (or BackendPool) to send the request with, the module default client if None.
+    :param job: Optional Img2ImgJob, records the backend running the request.
+    :param roi: Only render the region around the mask, scaled to the resolution, and blend the result back.
+                The reference hair image is not cropped, IP-Adapter takes it as a whole appearance reference.
+    :param reference_resolution: Size the reference hair image is sent at, the resolution if None.
+    """
+    if roi:
+        return roi_modification(
+            lambda source, mask, others, roi_resolution: adding_hair_modification(
+                source, reference_hair_image, mask, roi_resolution, client=client, job=job,
+                reference_resolution=reference_resolution or resolution),
+            source_image, inpaint_mask_bw_image, max_side=max(resolution))
+    payload = adding_hair_modification_payload(source_image, reference_hair_image, inpaint_mask_bw_image, resolution,
+                                               reference_resolution)
+
+    # Send request to the API
+    result = (client or default_client).img2img(payload, job=job)
+
+    return decode_result_image(result)
+
+def color_modification_payload(source_image, inpaint_mask_bw_image, color_text, resolution = (512,512), seed = -1, steps = 30):
+    """
+    Build the img2img payload of color_modification.
     """
     # Encode images to base64
     source_image_b64 = encode_image(source_image.resize(resolution))
-    inpaint_mask_b64 = encode_image(inpaint_mask_bw_image.resize(resolution))
+    inpaint_mask_b64 = encode_image(inpaint_mask_bw_image.resize(resolution), MASK_WIRE_FORMAT)
+    return color_modification_payload_b64(source_image_b64, inpaint_mask_b64, color_text, resolution, seed, steps)
 
+def color_modification_payload_b64(source_image_b64, inpaint_mask_b64, color_text, resolution = (512,512), seed = -1, steps = 30):
+    """
+    Build the img2img payload of color_modification from the already encoded (and resized) source image and mask.
+    """
     # Create payload
     payload = {
         "init_images": [source_image_b64],
@@ -190,12 +379,12 @@ def color_modification(source_image, inpaint_mask_bw_image, color_text, resoluti
         # "negative_prompt": "No unwanted artifacts, maintain original style.",
         "prompt": f"hair color {color_text}. cinematic photo. 35mm photograph, film, bokeh, professional, highly detailed",
         "negative_prompt": "drawing, painting, crayon, sketch, graphite, impressionist, noisy, blurry, soft, deformed",
-        "steps": 30,
+        "steps": steps,
         "sampler_name": "DPM++ 2M Karras",
         "cfg_scale": 7,
         "width": resolution[0],
         "height": resolution[1],
-        "seed": -1,
+        "seed": seed,
         "denoising_strength": 0.65,
         "mask_blur": 4,
         "inpainting_fill": 1,
@@ -224,33 +413,111 @@ def color_modification(source_image, inpaint_mask_bw_image, color_text, resoluti
         }
     }
 
+    return payload
+
+def color_modification(source_image, inpaint_mask_bw_image, color_text, resolution = (512,512), seed = -1, steps = 30, client=None, job=None, roi=False):
+    """
+    Modify the shape of the source image based on the reference shape image and inpaint mask.
+
+    :param source_image: Path to the source image to be modified.
+    :param reference_shape_image: Path to the reference shape image.
+    :param inpaint_mask_image: Path to the inpaint mask image.
+    :param output_image_path: Path where the modified image will be saved.
+    :param seed: Diffusion seed, -1 for a random one. A fixed seed makes the render reproducible, and cacheable.
+    :param steps: Sampling steps, fewer steps (with a lower resolution) give a quick preview.
+    :param client: Auto1111Client (or BackendPool) to send the request with, the module default client if None.
+    :param job: Optional Img2ImgJob, records the backend running the request.
+    :param roi: Only render the region around the mask, scaled to the resolution, and blend the result back.
+    """
+    if roi:
+        return roi_modification(
+            lambda source, mask, others, roi_resolution: color_modification(
+                source, mask, color_text, roi_resolution, seed, steps, client=client, job=job),
+            source_image, inpaint_mask_bw_image, max_side=max(resolution))
+    payload = color_modification_payload(source_image, inpaint_mask_bw_image, color_text, resolution, seed, steps)
+
     # Send request to the API
-    response = requests.post("http://127.0.0.1:7860/sdapi/v1/img2img", json=payload)
-    result = response.json()
+    result = (client or default_client).img2img(payload, job=job)
 
-    # Save the output image
-    if 'images' not in result or len(result['images']) == 0:
-        return None
-    else:
-        image_data = result['images'][0]
-        image_bytes = base64.b64decode(image_data)
+    return decode_result_image(result)
+
+def color_variants(source_image, inpaint_mask_bw_image, color_text, n_variants = 4, resolution = (512,512), seed = -1, client=None, job=None):
+    """
+    Render n_variants candidates of one color in a single img2img request. The candidates are one batch of the
+    backend (seeds seed, seed+1, ...), so the images are uploaded and ControlNet is prepared once.
+
+    :param n_variants: Number of candidates, the batch_size of the request.
+    :param seed: Seed of the first candidate, -1 for random ones.
+    :return: list of VersImage, empty if the backend returned no image.
+    """
+    payload = color_modification_payload(source_image, inpaint_mask_bw_image, color_text, resolution, seed)
+    payload["batch_size"] = n_variants
+    payload["override_settings"] = {"return_grid": False}  # The grid would come first, before the candidates
+
+    result = (client or default_client).img2img(payload, job=job)
 
-        vimage = VersImage.from_binary(image_bytes)
-        # vimage.image.show()
-        return vimage
+    return decode_result_images(result, count=n_variants)
 
+def color_modifications(source_image, inpaint_mask_bw_image, color_texts, resolution = (512,512), seed = -1, client=None, job=None):
+    """
+    Render the source image in each of the given colors. The source image and mask are resized and encoded once and
+    shared by the requests of all colors.
+
+    :param color_texts: List of color names.
+    :return: list with a VersImage (or None if the render failed) per color.
+    """
+    source_image_b64 = encode_image(source_image.resize(resolution))
+    inpaint_mask_b64 = encode_image(inpaint_mask_bw_image.resize(resolution), MASK_WIRE_FORMAT)
+    results = []
+    for color_text in color_texts:
+        payload = color_modification_payload_b64(source_image_b64, inpaint_mask_b64, color_text, resolution, seed)
+        results.append(decode_result_image((client or default_client).img2img(payload, job=job)))
+    return results
+
+def roi_resolution(size, max_side = 512):
+    """
+    Render resolution of a region of interest: its aspect ratio with the longest side at max_side, the working size
+    of the model, in multiples of 8. Small regions are upscaled (like A1111's inpaint full res), SD renders poorly
+    at a low resolution.
+    """
+    scale = max_side / max(size)
+    return tuple(max(64, int(round(side * scale / 8)) * 8) for side in size)
+
+def roi_modification(render_fn, source_image, inpaint_mask_bw_image, other_images = (), padding = 32, max_side = 512):
+    """
+    Run an inpainting modification on the region of interest of the mask only: the bounding box of the mask plus
+    padding is cropped from the source, mask and other images, rendered with its longest side at max_side (so the
+    region gets all the model's pixels), and the result is scaled back and feather blended into the full source.
+
+    :param render_fn: render_fn(source_crop, mask_crop, other_crops, resolution) -> VersImage or None.
+    :param other_images: Pixel aligned images of the same frame as the source to crop as well (e.g. a ControlNet
+                         map). Global references, like an IP-Adapter image, must be passed uncropped.
+    :return: Full size VersImage, the source itself if the mask is empty, or None if the render failed.
+    """
+    size = source_image.image.size
+    mask = inpaint_mask_bw_image.resize(size).image.convert('L')
+    bbox = mask_bbox(np.asarray(mask))
+    if bbox is None:
+        return source_image
+    box = roi_box(bbox, size, padding)
+    mask_crop = mask.crop(box)
+    other_crops = [VersImage.from_image(other.resize(size).image.crop(box)) for other in other_images]
+    result = render_fn(VersImage.from_image(source_image.image.crop(box)), VersImage.from_image(mask_crop),
+                       other_crops, roi_resolution(mask_crop.size, max_side))
+    if result is None:
+        return None
+    return VersImage.from_image(feather_blend(source_image.image, result.image, box, mask_crop))
 
-def get_progress():
-    API_URL = "http://127.0.0.1:7860/sdapi/v1/progress"
-    r = requests.get(API_URL)
-    data = r.json()
-    progress = int(data['progress'] * 100)
-    return progress
+def get_progress(client=None, job=None):
+    if job is not None:
+        return job.get_progress()
+    return (client or default_client).get_progress()
 
-def cancell_process():
-    API_URL = "http://127.0.0.1:7860/sdapi/v1/interrupt"
-    r = requests.post(API_URL)
-    if r.status_code == 200:
+def cancell_process(client=None, job=None):
+    r = job.interrupt() if job is not None else (client or default_client).interrupt()
+    if r is None:
+        print("No running process to cancel.")
+    elif r.status_code == 200:
         print("Process cancelled successfully.")
     else:
-        print(f"Failed to cancel process: {r.status_code} - {r.text}")
\ No newline at end of file
+        print(f"Failed to cancel process: {r.status_code} - {r.text}")
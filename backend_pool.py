@@ -0,0 +1,129 @@
+import threading
+
+import requests
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from auto1111_if import Auto1111Client
+
+
+def is_connect_failure(error):
+    """
+    True if a requests.ConnectionError happened while connecting, i.e. the request was never sent to the backend.
+    Errors after the request was sent (e.g. "Connection aborted") are not, the backend may still be rendering it.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, 'reason', reason)  # requests wraps the urllib3 error in a MaxRetryError
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class Backend:
+    """
+    One Automatic1111 instance of a BackendPool, with its client, number of outstanding jobs and health.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.outstanding = 0
+        self.healthy = True
+
+    @property
+    def base_url(self):
+        return self.client.base_url
+
+
+class BackendPool:
+    """
+    Dispatches img2img payloads across several Automatic1111 instances. Each job goes to the healthy backend with
+    the fewest outstanding jobs; if that backend cannot be connected to it is marked unhealthy and the job fails
+    over to the next one (a connection lost after the request was sent is raised instead, to not render it twice). Backends are health-checked against /sdapi/v1/progress, periodically when health_check_interval
+    is set. The pool has the same interface as Auto1111Client, so it can be passed as the client of the
+    auto1111_if functions or installed with set_default_client. Pass an Img2ImgJob to keep the progress and
+    interrupt requests of a job routed to the backend that owns it.
+
+    Example usage:
+        pool = BackendPool(["http://render-1:7860", "http://render-2:7860"], health_check_interval=10)
+        job = Img2ImgJob()
+        image = color_modification(source, mask, "Ash Blonde", client=pool, job=job)  # in a worker thread
+        print(get_progress(job=job))
+    """
+    def __init__(self, base_urls, health_check_interval=None, **client_kwargs):
+        """
+        :param base_urls: Base URLs of the Automatic1111 instances.
+        :param health_check_interval: Seconds between background health checks, None to only check on demand.
+        :param client_kwargs: Extra arguments of the Auto1111Client of each backend (timeouts, retries...).
+        """
+        self.backends = [Backend(Auto1111Client(base_url, **client_kwargs)) for base_url in base_urls]
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._health_thread = None
+        if health_check_interval:
+            self._health_thread = threading.Thread(target=self._health_loop, args=(health_check_interval,),
+                                                   name="a1111-health-check", daemon=True)
+            self._health_thread.start()
+
+    def check_health(self):
+        """Probe every backend and update its health, returns the list of healthy backends."""
+        for backend in self.backends:
+            try:
+                backend.client.fetch_progress()
+                backend.healthy = True
+            except (requests.RequestException, ValueError):
+                backend.healthy = False
+        return [backend for backend in self.backends if backend.healthy]
+
+    def img2img(self, payload, job=None):
+        tried = set()
+        while True:
+            backend = self._acquire(tried)
+            if backend is None:
+                raise requests.ConnectionError("No Automatic1111 backend available.")
+            try:
+                return backend.client.img2img(payload, job=job)
+            except requests.ConnectionError as e:
+                if not is_connect_failure(e):
+                    raise
+                # The request never reached this backend, try the next one
+                print(f"Warning: Backend {backend.base_url} unreachable, failing over: {e}")
+                backend.healthy = False
+                tried.add(backend)
+            finally:
+                with self._lock:
+                    backend.outstanding -= 1
+
+    def get_progress(self, job=None):
+        """Progress of the given job, or of the most advanced busy backend if no job is given."""
+        if job is not None:
+            return job.get_progress()
+        busy = [backend for backend in self.backends if backend.outstanding > 0]
+        return max((backend.client.get_progress() for backend in busy), default=0)
+
+    def interrupt(self, job=None):
+        """Interrupt the backend running the given job, or every busy backend if no job is given."""
+        if job is not None:
+            return job.interrupt()
+        response = None
+        for backend in self.backends:
+            if backend.outstanding > 0:
+                response = backend.client.interrupt()
+        return response
+
+    def close(self):
+        self._stop_event.set()
+        for backend in self.backends:
+            backend.client.close()
+
+    def _acquire(self, excluded):
+        with self._lock:
+            candidates = [backend for backend in self.backends if backend not in excluded]
+            # Unhealthy backends are still tried as a last resort, they may have recovered since the last check
+            healthy = [backend for backend in candidates if backend.healthy] or candidates
+            if not healthy:
+                return None
+            backend = min(healthy, key=lambda b: b.outstanding)
+            backend.outstanding += 1
+            return backend
+
+    def _health_loop(self, interval):
+        while not self._stop_event.wait(interval):
+            self.check_health()
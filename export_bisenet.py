@@ -0,0 +1,36 @@
+import argparse
+
+import torch
+
+from models.bisenet_model import BiSeNet, BiSeNetInference
+
+
+def export_bisenet(model_path, output_path, resolution=512):
+    """
+    Trace the face-parsing BiSeNet into a TorchScript artifact that HairMaskGenerator can load
+    with scripted_model_path, without constructing the Python module graph.
+
+    :param model_path: Path to the BiSeNet checkpoint (state dict).
+    :param output_path: Path where the TorchScript artifact will be saved.
+    :param resolution: Input resolution used for tracing, must match the HairMaskGenerator preprocessing.
+    """
+    net = BiSeNet(n_classes=19, pretrained_backbone=False)
+    net.load_state_dict(torch.load(model_path, map_location='cpu'))
+    model = BiSeNetInference(net.eval().fuse_for_inference()).eval()
+
+    example = torch.zeros(1, 3, resolution, resolution)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        traced = torch.jit.freeze(traced)
+    traced.save(output_path)
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the BiSeNet face-parsing model to TorchScript.")
+    parser.add_argument("--model", default="./models/79999_iter.pth", help="BiSeNet checkpoint to export")
+    parser.add_argument("--output", default="./models/79999_iter.torchscript.pt", help="Output TorchScript file")
+    parser.add_argument("--resolution", type=int, default=512, help="Input resolution used for tracing")
+    args = parser.parse_args()
+
+    print(f"Exported TorchScript model to {export_bisenet(args.model, args.output, args.resolution)}")
@@ -0,0 +1,80 @@
+import hashlib
+import os
+
+from PIL import Image, ImageOps
+
+
+def resize_image(img, present_resolution = 512):
+    old_ratio = 1.2
+    new_ratio = (1.6 + old_ratio) / 2.0
+    nw = int(img.width * new_ratio / old_ratio)
+    # Create a new blank RGB image with black padding
+    pad_width_offset = (nw - img.width) // 2
+    padded_img = ImageOps.expand(img,
+                                 border=(pad_width_offset, 0, pad_width_offset, 0), fill='black')
+    new_img = padded_img.resize((present_resolution, present_resolution))
+    return new_img
+
+
+class GalleryLoader:
+    """
+    Lazily turns the photos of a folder into gallery thumbnails (padded and resized with resize_image).
+    Thumbnails are cached on disk as PNG files keyed by the photo path, modification time and size, so only new or
+    changed photos are decoded, and the gallery is served from file paths instead of images held in memory.
+
+    Example usage:
+        loader = GalleryLoader("./my_pics")
+        for thumbnail_paths in loader.stream(first_batch_size=8):
+            gallery.update(value=thumbnail_paths)
+    """
+    def __init__(self, image_dir, cache_dir="./cache/thumbnails", present_resolution=512):
+        self.image_dir = image_dir
+        self.cache_dir = cache_dir
+        self.present_resolution = present_resolution
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def list_image_paths(self):
+        """Returns the paths of the photos in the folder, in a stable order."""
+        return [os.path.join(self.image_dir, filename) for filename in sorted(os.listdir(self.image_dir))
+                if filename.endswith(('.png', '.jpg', '.jpeg'))]
+
+    def thumbnail_path(self, img_path):
+        """Returns the path of the cached thumbnail of a photo, creating it first if needed."""
+        stat = os.stat(img_path)
+        key = f"{os.path.abspath(img_path)}|{stat.st_mtime_ns}|{stat.st_size}|{self.present_resolution}"
+        path = os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".png")
+        if not os.path.exists(path):
+            thumbnail = self._make_thumbnail(img_path)
+            tmp_path = f"{path}.{os.getpid()}.{id(thumbnail)}.tmp"
+            thumbnail.save(tmp_path, format="PNG")
+            os.replace(tmp_path, path)
+        return path
+
+    def stream(self, first_batch_size=8, growth=2):
+        """
+        Generator yielding the growing list of thumbnail paths. The first list has first_batch_size photos and each
+        next one is growth times longer, so the total number of paths yielded stays linear in the number of photos.
+        """
+        thumbnail_paths = []
+        next_yield, yielded = first_batch_size, None
+        for img_path in self.list_image_paths():
+            try:
+                thumbnail_paths.append(self.thumbnail_path(img_path))
+            except OSError as e:
+                print(f"Warning: Could not load {img_path}: {e}")
+                continue
+            if len(thumbnail_paths) == next_yield:
+                yield list(thumbnail_paths)
+                next_yield, yielded = next_yield * growth, len(thumbnail_paths)
+        if len(thumbnail_paths) != yielded:
+            yield list(thumbnail_paths)
+
+    @staticmethod
+    def open_thumbnail(thumbnail_path):
+        return Image.open(thumbnail_path).convert("RGB")
+
+    def _make_thumbnail(self, img_path):
+        img = Image.open(img_path)
+        # JPEGs can be decoded directly at a reduced scale, close to the presented resolution
+        img.draft("RGB", (self.present_resolution, self.present_resolution))
+        return resize_image(img.convert("RGB"), self.present_resolution)
@@ -1,42 +1,105 @@
-import gradio as gr
+import threading
+import time
+from collections import OrderedDict, deque
 from functools import partial
 
+import gradio as gr
+
+
+class ProgressRegistry:
+    """
+    Thread-safe record of the progress shown to each session, with a bounded history of its recent updates.
+    The least recently updated sessions are forgotten beyond max_sessions.
+
+    Example usage:
+        registry = ProgressRegistry()
+        registry.update(request.session_hash, 40, "Processing")
+        progress, label = registry.get(request.session_hash)
+    """
+    def __init__(self, history_size=32, max_sessions=1024):
+        self.history_size = history_size
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # session_id -> deque of (time, progress, label), oldest first
+
+    def update(self, session_id, progress, label):
+        with self._lock:
+            history = self._sessions.pop(session_id, None)
+            if history is None:
+                history = deque(maxlen=self.history_size)
+            history.append((time.time(), progress, label))
+            self._sessions[session_id] = history
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def get(self, session_id):
+        """Latest (progress, label) of a session, or None."""
+        with self._lock:
+            history = self._sessions.get(session_id)
+            return history[-1][1:] if history else None
+
+    def history(self, session_id):
+        """Recent (time, progress, label) updates of a session, oldest first."""
+        with self._lock:
+            return list(self._sessions.get(session_id, ()))
+
+    def clear(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
 class SyncedTaskWithProgress:
     """
-    Custom progress bar that can be used to track the progress of a synchronous function.
-    This class extends gr.Progress to provide a way to update the progress bar.
+    Progress bar (and optional cancel button) tracking a synchronous task of a session. One instance can serve all
+    sessions: each timer tick reports the progress of the calling session's own job, recorded in a ProgressRegistry,
+    so the app can run with concurrent handlers (demo.queue(default_concurrency_limit > 1)).
     Example usage:
-        def my_func(text_to_show):
-        global current_progress
-        print(text_to_show)
-        current_progress = 0
-        for i in range(100):
-            time.sleep(0.05)  # Simulate work
-            current_progress = i + 1
-            task_message = f"Processing... {current_progress}%"
-        print("Done...")
-
-    stwp = SyncedTaskWithProgress(slider_progress_bar, update_progress_function)
-    stwp.configure_sync_task(start_btn, long_task_function, {'text_to_show': "This is a long task"})
+        stwp = SyncedTaskWithProgress(slider_progress_bar, get_progress, job_queue=job_queue)
+        task_event = stwp.configure_sync_task(start_btn, long_task_function, {}, {'inputs': [state], 'outputs': [state]},
+                                              cancel_btn=cancel_btn)
+        stwp.configure_cancel(cancel_btn, [task_event])
     """
-    def __init__(self, progress_bar, get_status_fn, flag_is_visible_when_non_active=False):
+    def __init__(self, progress_bar, get_status_fn, flag_is_visible_when_non_active=False, job_queue=None):
+        """
+        :param get_status_fn: Function returning the progress (0-100), used when there is no job_queue.
+        :param job_queue: Optional JobQueue the work functions submit their jobs to. While the session's job waits
+                          in it, the progress bar shows the queue position; once it runs, the job's own progress.
+        """
         super().__init__()
         self.progress_bar = progress_bar
         # Timer component for periodic updates
         self.timer = gr.Timer(1, active=False)
         self.get_status_fn = get_status_fn
+        self.job_queue = job_queue
+        self.progress_registry = ProgressRegistry()
         self._flag_is_visible_when_non_active = flag_is_visible_when_non_active
 
         # Timer tick event for updating progress
         self.timer.tick(
-            fn=get_status_fn,
+            fn=self._get_status,
             outputs=[self.progress_bar]
         )
 
-        self._gradio_blocks_to_disable_during_task = []
-
-
-    def _run_sync_function_with_progress(self, work_fn, work_func_kwargs):
+    def _session_status(self, session_id):
+        if self.job_queue is None:
+            return self.get_status_fn(), "Progress"
+        job = self.job_queue.active_job(session_id)
+        if job is None:
+            # Between jobs of a task (e.g. preview and refine), keep showing the session's last progress
+            return self.progress_registry.get(session_id) or (0, "Progress")
+        if job.status == job.QUEUED:
+            return 0, f"Waiting in queue ({self.job_queue.position(job)} jobs ahead)"
+        return job.get_progress(), "Processing"
+
+    def _get_status(self, request: gr.Request):
+        progress, label = self._session_status(request.session_hash)
+        self.progress_registry.update(request.session_hash, progress, label)
+        return gr.update(value=progress, label=label)
+
+    def _cancel(self, request: gr.Request):
+        self.job_queue.cancel(request.session_hash)
+
+    def _run_sync_function_with_progress(self, work_fn, work_func_kwargs, gradio_blocks_to_disable_during_task=None):
         """
         Does the following (in this order):
          * Disable UI except the cancel button
@@ -45,46 +108,45 @@ class SyncedTaskWithProgress:
          * Once finished, re-enable the UI and update the progress bar to 100%
          * Return the result of the function
         """
-        global current_progress
-
         def disable_ui():
-            if self._gradio_blocks_to_disable_during_task:
-                for block in self._gradio_blocks_to_disable_during_task:
+            if gradio_blocks_to_disable_during_task:
+                for block in gradio_blocks_to_disable_during_task:
                     block.update(interactive=False)
             # return gr.update(interactive=False)
 
         def enable_ui():
-            if self._gradio_blocks_to_disable_during_task:
-                for block in self._gradio_blocks_to_disable_during_task:
+            if gradio_blocks_to_disable_during_task:
+                for block in gradio_blocks_to_disable_during_task:
                     block.update(interactive=True)
             # return gr.update(interactive=True)
 
         disable_ui()
 
         # Simulate work with progress updates
-        work_fn(**work_func_kwargs)
+        result = work_fn(**work_func_kwargs)
 
         enable_ui()
+        return result
 
-    def configure_sync_task(self, start_btn, work_fn, work_func_kwargs=None, gradio_blocks_to_interact=None, gradio_blocks_to_disable_during_task=None):
-
-        self._gradio_blocks_to_disable_during_task = gradio_blocks_to_disable_during_task
-
+    def configure_sync_task(self, start_btn, work_fn, work_func_kwargs=None, gradio_blocks_to_interact=None, gradio_blocks_to_disable_during_task=None,
+                            cancel_btn=None):
+        """
+        :param cancel_btn: Optional button shown while the task runs, wired once for all tasks by configure_cancel.
+        :return: The event running the task, to pass to configure_cancel.
+        """
         # Start button click event
-        def start_timer():
+        def start_timer(request: gr.Request):
             # print("Starting timer...")
+            self.progress_registry.clear(request.session_hash)  # Do not show the progress of the previous task
             return gr.Timer(active=True)
 
-        def stop_timer():
-            # print("Stropping timer...")
-            return gr.Timer(active=False)  # Stop the timer
-
         # Create a partial function with the work function and its arguments
         if work_func_kwargs:
             run_sync_partial = partial(
                 self._run_sync_function_with_progress,
                 work_fn=work_fn,
                 work_func_kwargs=work_func_kwargs,
+                gradio_blocks_to_disable_during_task=gradio_blocks_to_disable_during_task,
             )
         else:
             run_sync_partial = work_fn
@@ -94,23 +156,60 @@ class SyncedTaskWithProgress:
             inputs_blocks = gradio_blocks_to_interact['inputs']
             outputs_blocks = gradio_blocks_to_interact['outputs']
 
-        start_btn.click(
+        indicators = [self.progress_bar] + ([cancel_btn] if cancel_btn is not None else [])
+
+        def show_indicators():
+            return [gr.update(visible=True)] * len(indicators)
+
+        task_event = start_btn.click(
             start_timer,
             outputs=[self.timer],
         ).then(
-            fn=lambda: gr.update(visible=True),
+            fn=show_indicators,
             inputs=[],
-            outputs=[self.progress_bar],
+            outputs=indicators,
         ).then(
             fn=run_sync_partial,
             inputs=inputs_blocks,
             outputs=outputs_blocks,
+        )
+        task_event.then(
+            self._stop_timer,
+            outputs=[self.timer],
         ).then(
-            stop_timer,
+            fn=partial(self._hide_indicators, len(indicators)),
+            inputs=[],
+            outputs=indicators,
+        )
+        return task_event
+
+    def configure_cancel(self, cancel_btn, task_events, cancel_fn=None):
+        """
+        Wire a cancel button once for all the tasks it can cancel, so a click cancels the session's work once.
+
+        :param task_events: Events returned by configure_sync_task, stopped by the click.
+        :param cancel_fn: Function interrupting the work, by default the session's jobs in the job queue are
+                          cancelled (dropped if queued, interrupted on their backend if running).
+        """
+        if cancel_fn is None and self.job_queue is not None:
+            cancel_fn = self._cancel
+        cancel_btn.click(
+            fn=cancel_fn,
+            cancels=task_events,
+        ).then(
+            self._stop_timer,
             outputs=[self.timer],
         ).then(
-            fn=lambda: gr.update(visible=self._flag_is_visible_when_non_active),
+            fn=partial(self._hide_indicators, 2),
             inputs=[],
-            outputs=[self.progress_bar],
+            outputs=[self.progress_bar, cancel_btn],
         )
 
+    @staticmethod
+    def _stop_timer():
+        # print("Stropping timer...")
+        return gr.Timer(active=False)  # Stop the timer
+
+    def _hide_indicators(self, count):
+        # The progress bar first, then the cancel button if any
+        return [gr.update(visible=self._flag_is_visible_when_non_active)] + [gr.update(visible=False)] * (count - 1)
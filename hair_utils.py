@@ -1,24 +1,107 @@
 
-from models.bisenet_model import BiSeNet
+from models.bisenet_model import BiSeNet, BiSeNetInference
+from tiered_cache import TieredCache
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+import io
+import os
+import threading
+import zipfile
+import numpy as np
 import torch
+import torch.nn.functional as F
 from torchvision import transforms
 from PIL import Image
 
+HAIR_CLASS = 17
+
 class HairMaskGenerator:
-    def __init__(self, model_path='./models/79999_iter.pth'):
+    def __init__(self, model_path='./models/79999_iter.pth', low_res_margin=False, margin_threshold=0.0,
+                 scripted_model_path=None, quantized_model_path=None,
+                 cache_max_bytes=64 * 1024 * 1024, cache_dir=None, cache_max_disk_bytes=None,
+                 precompute_workers=1):
         """
         Initialize the HairMaskGenerator with the path to the pre-trained BiSeNet model.
+
+        :param low_res_margin: If True, compute the hair logit margin (hair class against the best other class)
+                               at the 1/8 feature resolution and upsample only that single channel, instead of
+                               upsampling all 19 class logits and running a full-resolution argmax.
+        :param margin_threshold: Pixels whose upsampled margin is above this value are hair. 0.0 follows the argmax
+                                 decision boundary; use mask_iou to check the result against the full-resolution path.
+        :param scripted_model_path: Path to a TorchScript artifact created by export_bisenet.py. When given it is
+                                    loaded instead of building BiSeNet and loading model_path.
+        :param quantized_model_path: Path to an INT8 TorchScript artifact created by quantize_bisenet.py. The quantized
+                                     engine it was calibrated for is selected before loading it.
+        :param cache_max_bytes: Memory budget of the mask cache, keyed by a hash of the image pixels, so re-applying
+                                edits to an unchanged image does not run BiSeNet again. 0 disables the memory tier.
+        :param cache_dir: Optional folder for an on-disk tier of the mask cache, kept across restarts.
+        :param cache_max_disk_bytes: Maximum total size of the disk tier, the oldest masks are evicted beyond it.
+                                     Unbounded if None.
+        :param precompute_workers: Size of the background pool used by precompute.
         """
         self.model_path = model_path
-        self.net = BiSeNet(n_classes=19)
-        self.net.load_state_dict(torch.load(self.model_path))
+        self.low_res_margin = low_res_margin
+        self.margin_threshold = margin_threshold
+        self.scripted_model_path = scripted_model_path
+        self.quantized_model_path = quantized_model_path
+        # self.net maps a batch of images to the fused head logits at 1/8 resolution
+        if quantized_model_path:
+            # Packed INT8 weights are unpacked for the active engine while loading, so select it first
+            torch.backends.quantized.engine = read_quantized_engine(quantized_model_path) or select_quantized_engine()
+            self.net = torch.jit.load(quantized_model_path, map_location='cpu')
+        elif scripted_model_path:
+            self.net = torch.jit.load(scripted_model_path, map_location='cpu')
+        else:
+            # The checkpoint holds the full network, so skip the ImageNet backbone weights it would overwrite
+            bisenet = BiSeNet(n_classes=19, pretrained_backbone=False)
+            bisenet.load_state_dict(torch.load(self.model_path, map_location='cpu'))
+            self.net = BiSeNetInference(bisenet.eval().fuse_for_inference())
         self.net.eval()
-        self.to_tensor = transforms.Compose([
-            transforms.Resize((512, 512)),
+        self.to_tensor = self.preprocessing()
+
+        self.mask_cache = None
+        if cache_max_bytes or cache_dir:
+            self.mask_cache = TieredCache(cache_max_bytes, sizeof=lambda mask: mask.nbytes,
+                                          cache_dir=cache_dir, dump=_dump_mask, load=_load_mask,
+                                          max_disk_bytes=cache_max_disk_bytes)
+        # Masks depend on the model and the segmentation mode, not only on the image
+        model_id = os.path.basename(quantized_model_path or scripted_model_path or model_path)
+        self._cache_namespace = f"{model_id}-{int(low_res_margin)}-{margin_threshold}"
+
+        self.precompute_workers = precompute_workers
+        self._executor = None
+        self._pending = {}  # cache key -> (future of a precompute batch, index in the batch)
+        self._pending_lock = threading.Lock()
+
+    @staticmethod
+    def preprocessing(resolution=512):
+        """
+        The transform turning a PIL image into the normalized tensor BiSeNet expects.
+        """
+        return transforms.Compose([
+            transforms.Resize((resolution, resolution)),
             transforms.ToTensor(),
             transforms.Normalize([0.5]*3, [0.5]*3)
         ])
 
+    def _masks_from_batch(self, batch):
+        """
+        Run BiSeNet on a batch of preprocessed images and return the hair masks as an (N, H, W) uint8 array.
+        """
+        with torch.no_grad():
+            logits = self.net(batch)
+            if self.low_res_margin:
+                others = torch.cat([logits[:, :HAIR_CLASS], logits[:, HAIR_CLASS + 1:]], dim=1).amax(1, keepdim=True)
+                margin = logits[:, HAIR_CLASS:HAIR_CLASS + 1] - others
+                margin = F.interpolate(margin, batch.size()[2:], mode='bilinear', align_corners=True)
+                hair = margin[:, 0] > self.margin_threshold
+            else:
+                logits = F.interpolate(logits, batch.size()[2:], mode='bilinear', align_corners=True)
+                parsing = logits.argmax(1)
+                hair = parsing == HAIR_CLASS
+
+        return hair.numpy().astype("uint8") * 255
+
     def generate_hair_mask(self, image):
         """
         Generate a hair mask from an image using the pre-trained BiSeNet model.
@@ -27,15 +110,152 @@ class HairMaskGenerator:
         :param image: PIL Image object
         :return: numpy array representing the hair mask
         """
-        img_tensor = self.to_tensor(image).unsqueeze(0)
+        key = self._cache_key(image)
+        hair_mask = self._cache_get(key)
+        if hair_mask is None:
+            hair_mask = self._wait_pending(key)
+        if hair_mask is None:
+            img_tensor = self.to_tensor(image).unsqueeze(0)
+            hair_mask = self._cache_put(key, self._masks_from_batch(img_tensor)[0])
+        return hair_mask
 
-        with torch.no_grad():
-            out = self.net(img_tensor)[0]
-            parsing = out.squeeze(0).argmax(0).numpy()
-            hair_mask = (parsing == 17).astype("uint8") * 255
+    def generate_hair_masks(self, images, batch_size=8):
+        """
+        Generate hair masks for several images, running BiSeNet once per batch
+        instead of once per image.
+
+        :param images: iterable of PIL Image objects
+        :param batch_size: number of images stacked into a single forward pass
+        :return: list of numpy arrays representing the hair masks, in the order of the input images
+        """
+        images = list(images)
+        keys = [self._cache_key(image) for image in images]
+        hair_masks = [self._cache_get(key) for key in keys]
+
+        # Only the images missing from the cache go through BiSeNet
+        missing = [i for i, hair_mask in enumerate(hair_masks) if hair_mask is None]
+        for start in range(0, len(missing), batch_size):
+            indices = missing[start:start + batch_size]
+            batch = torch.stack([self.to_tensor(images[i]) for i in indices])
+            for i, hair_mask in zip(indices, self._masks_from_batch(batch)):
+                hair_masks[i] = self._cache_put(keys[i], hair_mask)
+
+        return hair_masks
+
+    def precompute(self, images, batch_size=8):
+        """
+        Schedule hair masks for images on a bounded background pool. The masks land in the mask cache, and
+        generate_hair_mask calls for an image that is being processed wait for it instead of running again.
 
+        :param images: iterable of PIL Image objects or image file paths (opened by the background worker)
+        :param batch_size: number of images per background forward pass
+        :return: list of futures, one per batch, resolving to the list of masks of that batch
+        """
+        if self.mask_cache is None:
+            raise ValueError("precompute requires the mask cache to be enabled.")
+        with self._pending_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.precompute_workers,
+                                                    thread_name_prefix="hair-mask-precompute")
+
+        images = list(images)
+        return [self._executor.submit(self._precompute_batch, images[start:start + batch_size])
+                for start in range(0, len(images), batch_size)]
+
+    def _precompute_batch(self, batch):
+        images = [Image.open(image).convert("RGB") if isinstance(image, str) else image for image in batch]
+        keys = [self._cache_key(image) for image in images]
+        future = Future()
+        with self._pending_lock:
+            for index, key in enumerate(keys):
+                self._pending.setdefault(key, (future, index))
+        try:
+            hair_masks = self.generate_hair_masks(images, batch_size=len(images))
+            future.set_result(hair_masks)
+            return hair_masks
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._pending_lock:
+                for key in keys:
+                    if self._pending.get(key, (None,))[0] is future:
+                        del self._pending[key]
+
+    def _wait_pending(self, key):
+        with self._pending_lock:
+            pending = self._pending.get(key)
+        if pending is None:
+            return None
+        future, index = pending
+        try:
+            return future.result()[index]
+        except Exception:
+            return None  # the caller segments the image itself
+
+    def _cache_key(self, image):
+        return f"{self._cache_namespace}-{image_digest(image)}" if self.mask_cache is not None else None
+
+    def _cache_get(self, key):
+        return self.mask_cache.get(key) if self.mask_cache is not None else None
+
+    def _cache_put(self, key, hair_mask):
+        # Cached masks are shared between callers, so hand out read-only arrays that own their memory
+        hair_mask = hair_mask.copy()
+        hair_mask.setflags(write=False)
+        if self.mask_cache is not None:
+            self.mask_cache.put(key, hair_mask)
         return hair_mask
 
+def image_digest(image):
+    """
+    Content hash of a PIL image: its mode, size and pixels.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}-{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def _dump_mask(hair_mask):
+    buffer = io.BytesIO()
+    np.save(buffer, hair_mask)
+    return buffer.getvalue()
+
+def _load_mask(data):
+    hair_mask = np.load(io.BytesIO(data))
+    hair_mask.setflags(write=False)
+    return hair_mask
+
+def select_quantized_engine():
+    """
+    Pick the best quantized engine supported by this torch build: x86/fbgemm on Intel/AMD, qnnpack on ARM.
+    """
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in torch.backends.quantized.supported_engines:
+            return engine
+    raise RuntimeError("No quantized engine available in this torch build.")
+
+def read_quantized_engine(path):
+    """
+    Return the quantized engine recorded by quantize_bisenet.py in a TorchScript artifact, or None.
+    """
+    with zipfile.ZipFile(path) as archive:
+        for name in archive.namelist():
+            if name.endswith('/extra/quantized_engine'):
+                return archive.read(name).decode()
+    return None
+
+def mask_iou(mask_a, mask_b):
+    """
+    Intersection over union of two hair masks (non-zero pixels are hair).
+    Two empty masks are considered identical.
+    """
+    a, b = np.asarray(mask_a) > 0, np.asarray(mask_b) > 0
+    union = np.logical_or(a, b).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(a, b).sum() / union)
+
 def generate_hair_mask(image):
     """
     Generate a hair mask from an image using a pre-trained BiSeNet model.
@@ -0,0 +1,174 @@
+import itertools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from auto1111_if import Img2ImgJob, cancell_process
+
+
+class JobSuperseded(Exception):
+    """Raised to the submitter of a job that was replaced by a newer job of the same session before it ran."""
+
+
+class JobCancelled(JobSuperseded):
+    """Raised to the submitter of a running job that was interrupted, by JobQueue.cancel or a newer job."""
+
+
+class QueuedJob(Img2ImgJob):
+    """
+    A job waiting in (or dispatched by) a JobQueue. It is also the Img2ImgJob handed to the work function, so the
+    backend running it is recorded and its progress can be reported per job.
+    """
+    QUEUED, RUNNING, DONE, SUPERSEDED, CANCELLED = "queued", "running", "done", "superseded", "cancelled"
+
+    def __init__(self, session_id, work_fn):
+        super().__init__()
+        self.session_id = session_id
+        self.work_fn = work_fn
+        self.status = QueuedJob.QUEUED
+        self.future = Future()
+
+
+class JobQueue:
+    """
+    Sits between the UI handlers and the Automatic1111 backends: at most max_in_flight jobs run at once, at most
+    max_in_flight_per_session of them for the same session, and sessions take turns (round robin: the session
+    served least recently goes first, new sessions before served ones) so one user's clicks cannot starve the
+    others. Submitting with supersede=True drops the session's jobs that have not started
+    yet, e.g. a stale color selection, and interrupts its running job on the backend, like cancel().
+
+    Example usage:
+        job_queue = JobQueue(max_in_flight=2)
+        image = job_queue.run(session_id, lambda job: color_modification(source, mask, color, job=job))
+    """
+    def __init__(self, max_in_flight=1, max_in_flight_per_session=1):
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_session = max_in_flight_per_session
+
+        self._condition = threading.Condition()
+        self._pending = OrderedDict()  # session_id -> deque of queued jobs, in order of arrival of the sessions
+        self._running = {}  # session_id -> set of running jobs
+        self._last_served = {}  # session_id -> dispatch number of its last job, while it has queued or running jobs
+        self._dispatch_count = itertools.count()
+        self._active = {}  # session_id -> latest queued or running job
+        self._workers = [threading.Thread(target=self._worker_loop, name=f"job-queue-{i}", daemon=True)
+                         for i in range(max_in_flight)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, session_id, work_fn, supersede=True):
+        """
+        Queue work_fn(job) for a session and return its QueuedJob; the result is available from job.future.
+
+        :param supersede: Drop the jobs of this session that are still waiting in the queue and interrupt its
+                          running job.
+        """
+        if supersede:
+            self.cancel(session_id)
+        job = QueuedJob(session_id, work_fn)
+        with self._condition:
+            self._pending.setdefault(session_id, deque()).append(job)
+            self._active[session_id] = job
+            self._condition.notify()
+        return job
+
+    def run(self, session_id, work_fn, supersede=True):
+        """Submit work_fn(job) and wait for its result. Raises JobSuperseded if a newer job replaced it."""
+        return self.submit(session_id, work_fn, supersede).future.result()
+
+    def cancel(self, session_id):
+        """
+        Drop the queued jobs of a session and interrupt its running ones on their backend, e.g. when the user
+        cancels or leaves the screen. Their submitters get JobSuperseded (JobCancelled for the running ones).
+        """
+        with self._condition:
+            self._drop_pending(session_id)
+            # Jobs already cancelled are skipped: A1111 interrupts whatever it runs, a late second interrupt could
+            # stop the next job on that backend
+            running_jobs = [job for job in self._running.get(session_id, ()) if job.status == QueuedJob.RUNNING]
+            for job in running_jobs:
+                job.status = QueuedJob.CANCELLED
+        for job in running_jobs:
+            cancell_process(job=job)
+
+    def active_job(self, session_id):
+        """The latest queued or running job of a session, or None."""
+        with self._condition:
+            return self._active.get(session_id)
+
+    def position(self, job):
+        """Number of queued jobs that will start before the given one (0 if it is next or already running)."""
+        with self._condition:
+            if job.status != QueuedJob.QUEUED:
+                return 0
+            ahead = 0
+            queues = [self._pending[session_id] for session_id in self._turn_order()]
+            for round_index in itertools.count():
+                round_has_jobs = False
+                for queue in queues:
+                    if round_index < len(queue):
+                        round_has_jobs = True
+                        if queue[round_index] is job:
+                            return ahead
+                        ahead += 1
+                if not round_has_jobs:
+                    return ahead
+
+    def _drop_pending(self, session_id):
+        for stale_job in self._pending.pop(session_id, ()):
+            stale_job.status = QueuedJob.SUPERSEDED
+            stale_job.future.set_exception(JobSuperseded())
+            if self._active.get(session_id) is stale_job:
+                del self._active[session_id]
+        self._forget_if_idle(session_id)
+
+    def _forget_if_idle(self, session_id):
+        if session_id not in self._pending and session_id not in self._running:
+            self._last_served.pop(session_id, None)
+
+    def _turn_order(self):
+        # Sessions with queued jobs, least recently served first (sorted is stable, so ties keep arrival order)
+        return sorted(self._pending, key=lambda session_id: self._last_served.get(session_id, -1))
+
+    def _next_job(self):
+        # Round robin: the first session in turn order with room under its in-flight limit
+        for session_id in self._turn_order():
+            if len(self._running.get(session_id, ())) < self.max_in_flight_per_session:
+                queue = self._pending[session_id]
+                job = queue.popleft()
+                if not queue:
+                    del self._pending[session_id]
+                self._last_served[session_id] = next(self._dispatch_count)
+                return job
+        return None
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    self._condition.wait()
+                    job = self._next_job()
+                job.status = QueuedJob.RUNNING
+                self._running.setdefault(job.session_id, set()).add(job)
+
+            try:
+                result = job.work_fn(job)
+                if job.status == QueuedJob.CANCELLED:  # The backend returns the partial render of interrupted jobs
+                    job.future.set_exception(JobCancelled())
+                else:
+                    job.future.set_result(result)
+            except Exception as e:
+                job.future.set_exception(JobCancelled() if job.status == QueuedJob.CANCELLED else e)
+            finally:
+                with self._condition:
+                    if job.status != QueuedJob.CANCELLED:
+                        job.status = QueuedJob.DONE
+                    running_jobs = self._running[job.session_id]
+                    running_jobs.discard(job)
+                    if not running_jobs:
+                        del self._running[job.session_id]
+                        self._forget_if_idle(job.session_id)
+                    if self._active.get(job.session_id) is job:
+                        del self._active[job.session_id]
+                    self._condition.notify_all()
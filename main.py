@@ -1,45 +1,44 @@
+import threading
+
 import gradio as gr
-import os
-from PIL import Image, ImageOps, ImageDraw
+from PIL import Image, ImageDraw
 
-from auto1111_if import color_modification, get_progress, adding_hair_modification
+from auto1111_if import (color_modification, color_modification_payload, decode_result_image, get_progress,
+                         adding_hair_modification, set_default_client)
+from backend_pool import BackendPool
+from result_cache import CachingClient, Img2ImgResultCache
 from color_pallete import ColorPalette
-from hair_utils import HairMaskGenerator
+from gallery_loader import GalleryLoader
+from hair_utils import HairMaskGenerator, image_digest
+from render_farm import RenderStore
 from vers_image import VersImage
 from gr_synced_task_with_progress import SyncedTaskWithProgress
-import numpy as np
-
-def resize_image(img, present_resolution = 512):
-    old_ratio = 1.2
-    new_ratio = (1.6 + old_ratio) / 2.0
-    nw = int(img.width * new_ratio / old_ratio)
-    # Create a new blank RGB image with black padding
-    pad_width_offset = (nw - img.width) // 2
-    padded_img = ImageOps.expand(img,
-                                 border=(pad_width_offset, 0, pad_width_offset, 0), fill='black')
-    new_img = padded_img.resize((present_resolution, present_resolution))
-    return new_img
-
-
-def load_images():
-    # Load images from a directory
-    image_dir = "C:/Users/Lab/Downloads/my_pics"
-
-    images = []
-    for filename in os.listdir(image_dir):
-        if filename.endswith(('.png', '.jpg', '.jpeg')):
-            img_path = os.path.join(image_dir, filename)
-            img = Image.open(img_path)
-            images.append(resize_image(img))
-
-    return images
-
+from job_queue import JobQueue, JobSuperseded
+from mask_compositing import apply_mask, find_drawn_region, region_to_mask
 
 # Define the total number of screens
 NUM_SCREENS = 3
+# Automatic1111 render nodes, img2img jobs are balanced between them
+A1111_BACKEND_URLS = ["http://127.0.0.1:7860"]
+# Color renders use a fixed seed, so identical (photo, color) requests are rendered once and then served from cache
+COLOR_SEED = 1234
+# A quick low resolution preview is shown first, then swapped for the full quality render
+PREVIEW_RESOLUTION, PREVIEW_STEPS = (256, 256), 8
+REFINE_RESOLUTION, REFINE_STEPS = (512, 512), 30
+# Renders precomputed offline for every gallery photo and palette color (see render_farm.py)
+render_store = RenderStore("./renders")
+render_cache = Img2ImgResultCache(cache_dir="./cache/renders", max_disk_bytes=2 * 1024 ** 3)
+set_default_client(CachingClient(BackendPool(A1111_BACKEND_URLS, health_check_interval=10), render_cache))
+# Render requests of all sessions are queued fairly, one running job per backend and per session
+job_queue = JobQueue(max_in_flight=len(A1111_BACKEND_URLS), max_in_flight_per_session=1)
+# session_hash -> Event set once the session's color refine has replaced its preview, or dropped it
+pending_refines = {}
 color_pallete = ColorPalette()
 color_pallete_categories = sorted(color_pallete.get_all_categories())
-hair_mask_generator = HairMaskGenerator()
+hair_mask_generator = HairMaskGenerator(cache_dir="./cache/hair_masks", cache_max_disk_bytes=512 * 1024 ** 2)
+# Photos are turned into cached thumbnails lazily, while the gallery streams in after the page loads
+gallery_loader = GalleryLoader("C:/Users/Lab/Downloads/my_pics")
+precomputed_thumbnails = set()  # shared by all sessions, each thumbnail is segmented once
 
 
 # --- 1. State Management ---
@@ -52,13 +51,37 @@ def create_initial_state():
     return 0, {}  # screen_index, user_data
 
 
+def stream_gallery(gallery_paths):
+    """
+    Streams the gallery thumbnails as they become available, and segments them in the background
+    so the apply handlers find the masks ready in the mask cache.
+    The session's gallery_paths state is extended in place, only the gallery itself is updated.
+    """
+    for thumbnail_paths in gallery_loader.stream():
+        gallery_paths.extend(thumbnail_paths[len(gallery_paths):])
+        new_paths = [path for path in thumbnail_paths if path not in precomputed_thumbnails]
+        precomputed_thumbnails.update(new_paths)
+        hair_mask_generator.precompute(new_paths)
+        yield thumbnail_paths
+
+
 # --- 2. Logic for Navigation and Data Handling ---
 
-def change_screen(screen_index, direction, user_data, working_images):
+def change_screen(screen_index, direction, user_data, working_images, request: gr.Request):
     """
     This is the core function that handles screen transitions and data saving.
     It's triggered by the 'Next' and 'Previous' buttons.
     """
+    if direction == "next" and screen_index == 1:
+        # The colored image is carried forward to the edit screen: let its refine finish rather than editing the
+        # preview
+        refine_done = pending_refines.get(request.session_hash)
+        if refine_done is not None:
+            refine_done.wait()
+    else:
+        # Renders still waiting for the screen we leave are not needed anymore
+        job_queue.cancel(request.session_hash)
+
     # --- Data Saving ---
     # Save the input from the *previous* screen before changing the index.
     if direction == "next":
@@ -104,13 +127,17 @@ def change_screen(screen_index, direction, user_data, working_images):
     # The order of returned values must match the order of the `outputs` list in the .click() event.
     return [screen_index, user_data] + screen_updates + [prev_btn_update, next_btn_update] + [working_images,drawing_canvas_new_image]
 
-def apply_colors(user_data, working_images):
+def apply_colors(user_data, working_images, request: gr.Request):
     """
-    Apply the selected colors to the working images.
-    This function is a placeholder and should be replaced with actual processing logic.
+    Apply the selected color to the last working image. A low resolution preview is yielded first, then replaced
+    by the full quality render (no preview if that render is already cached). If the refine is cancelled, the
+    preview is removed again rather than kept as the result.
     """
-    # For now, just return the working images as is.
-    # In a real application, you would apply the selected colors to the images here.
+    # A newer color selection supersedes the session's pending refine, wait until its preview is dropped
+    refine_done = pending_refines.get(request.session_hash)
+    if refine_done is not None:
+        job_queue.cancel(request.session_hash)
+        refine_done.wait()
     if 'images' in user_data:
         cur_image = working_images[-1]  # Get the last selected image
     else:
@@ -119,17 +146,71 @@ def apply_colors(user_data, working_images):
         selected_color_code = user_data['selected_color_code']
     else:
         print("No color selected, returning original image.")
-        return working_images
+        yield working_images
+        return
+    precomputed_image = render_store.get(image_digest(cur_image), selected_color_code)
+    if precomputed_image is not None:
+        working_images.append(precomputed_image)
+        yield working_images
+        return
     selected_color_name = color_pallete.get_color_by_code(selected_color_code)["Name"]
     hair_mask = hair_mask_generator.generate_hair_mask(cur_image)
     print(f"Applying color: {selected_color_name} to the hair mask.")
-    colored_image = color_modification(VersImage.from_image(cur_image), VersImage.from_numpy(hair_mask), selected_color_name)
-    if colored_image is None:
-        raise Exception("Operation failed, check that the automatic1111 server is running.")
-    working_images.append(colored_image.image)
-    return working_images
-
-def apply_edits(drawing_canvas, user_data, working_images):
+    # Shared by the requests, so the images are encoded once
+    source, mask = VersImage.from_image(cur_image), VersImage.from_numpy(hair_mask)
+
+    cached_result = render_cache.get(color_modification_payload(source, mask, selected_color_name,
+                                                                REFINE_RESOLUTION, COLOR_SEED, REFINE_STEPS))
+    cached_image = decode_result_image(cached_result) if cached_result is not None else None
+    if cached_image is not None:
+        working_images.append(cached_image.image)
+        yield working_images
+        return
+
+    def render(resolution, steps):
+        return job_queue.run(request.session_hash, lambda job: color_modification(
+            source, mask, selected_color_name, resolution=resolution, seed=COLOR_SEED, steps=steps, job=job))
+
+    refine_done = pending_refines[request.session_hash] = threading.Event()
+
+    def finish_refine():
+        # Set before the last yield: a cancelled event is not resumed after it
+        refine_done.set()
+        if pending_refines.get(request.session_hash) is refine_done:
+            del pending_refines[request.session_hash]
+
+    try:
+        try:
+            preview_image = render(PREVIEW_RESOLUTION, PREVIEW_STEPS)
+        except JobSuperseded:
+            print("Color selection cancelled or superseded by a newer one, skipping.")
+            finish_refine()
+            yield working_images
+            return
+        if preview_image is None:
+            raise Exception("Operation failed, check that the automatic1111 server is running.")
+        preview = preview_image.image.resize(REFINE_RESOLUTION)
+        working_images.append(preview)
+        yield working_images
+
+        try:
+            colored_image = render(REFINE_RESOLUTION, REFINE_STEPS)
+            if colored_image is None:
+                print("Warning: Color refine failed, dropping the preview.")
+        except JobSuperseded:
+            print("Color refine cancelled, dropping the preview.")
+            colored_image = None
+        if colored_image is None:
+            if working_images and working_images[-1] is preview:
+                working_images.pop()  # The preview is never carried forward as the result
+        else:
+            working_images[-1] = colored_image.image
+        finish_refine()
+        yield working_images
+    finally:
+        finish_refine()
+
+def apply_edits(drawing_canvas, user_data, working_images, request: gr.Request):
     """
     Apply the edits made on the drawing canvas to the working images.
     This function is a placeholder and should be replaced with actual processing logic.
@@ -153,17 +234,14 @@ def apply_edits(drawing_canvas, user_data, working_images):
         comp_img = drawing_canvas['composite']
         if background_img is None or comp_img is None:
             return working_images
-        xor_img = np.bitwise_xor(background_img,
-                                 comp_img)
-        drawing_mask = (xor_img.sum(axis=2) > 0)
-        if drawing_mask.sum() == 0:
+        drawn_region = find_drawn_region(background_img, comp_img)
+        if drawn_region is None:
             print("No drawing mask found, returning original image.")
             return working_images
 
         hair_mask = hair_mask_generator.generate_hair_mask(cur_image)
-        hair = np.array(cur_image) * (hair_mask[:,:, None] > 0)  # Apply hair mask to the current image
-        hair_img = Image.fromarray(hair.astype(np.uint8))
-        drawing_mask_img = Image.fromarray((drawing_mask * 255).astype(np.uint8))
+        hair_img = Image.fromarray(apply_mask(cur_image, hair_mask))  # Apply hair mask to the current image
+        drawing_mask_img = Image.fromarray(region_to_mask(background_img.shape, *drawn_region))
 
         if flag_debug_drawing_save_images: # Debug
             drawing_mask_img.save("C:/Users/Lab/Downloads/drawing_mask.png")
@@ -174,8 +252,15 @@ def apply_edits(drawing_canvas, user_data, working_images):
     # # Apply the drawing mask to the current image
     # edited_image = Image.fromarray(np.array(cur_image) * drawing_mask[:, :, None])
     #
-    modified_image = adding_hair_modification(VersImage.from_image(cur_image), VersImage.from_image(hair_img),
-                                              VersImage.from_image(drawing_mask_img))
+    try:
+        modified_image = job_queue.run(request.session_hash, lambda job: adding_hair_modification(
+            VersImage.from_image(cur_image), VersImage.from_image(hair_img), VersImage.from_image(drawing_mask_img),
+            job=job, roi=True))  # Strokes are usually small, their region gets the full render resolution
+    except JobSuperseded:
+        print("Edit cancelled or superseded by a newer one, skipping.")
+        return working_images
+    if modified_image is None:
+        raise Exception("Operation failed, check that the automatic1111 server is running.")
     working_images.append(modified_image.image)
     return working_images
 
@@ -201,12 +286,16 @@ with gr.Blocks(theme=gr.themes.Soft(), css="footer {display: none !important}")
                     gr.Image(interactive=False, value=r"./resources/right_arrow.png", scale=0, show_label=False, show_download_button=False, show_fullscreen_button=False)
 
     progress_bar = gr.Slider(visible=False)
-    gstwp = SyncedTaskWithProgress(progress_bar, get_progress, flag_is_visible_when_non_active=False)
+    cancel_button = gr.Button("Cancel", variant="stop", visible=False)
+    task_events = []  # Events of the tasks the cancel button stops
+    gstwp = SyncedTaskWithProgress(progress_bar, get_progress, flag_is_visible_when_non_active=False,
+                                   job_queue=job_queue)
+
+    gallery_paths = gr.State([])
 
-    def on_gallery_img_select(evt: gr.SelectData, user_data):
-        img_url = evt.value['image']['path']
-        img = Image.open(img_url)
-        user_data['selected_image'] = img
+    def on_gallery_img_select(evt: gr.SelectData, gallery_paths, user_data):
+        # Open our own thumbnail rather than the gallery's copy, so the pixels match its precomputed mask
+        user_data['selected_image'] = GalleryLoader.open_thumbnail(gallery_paths[evt.index])
 
         return user_data
 
@@ -214,8 +303,8 @@ with gr.Blocks(theme=gr.themes.Soft(), css="footer {display: none !important}")
     with gr.Column(visible=True) as screen1:
         gr.Markdown("## Select Picture")
         # gr.Markdown("Please enter your name to personalize the installation.")
-        gallery = gr.Gallery(label="Image Gallery", show_label=True, columns=4, value=load_images())
-        gallery.select(fn=on_gallery_img_select, inputs=user_data, outputs=user_data)
+        gallery = gr.Gallery(label="Image Gallery", show_label=True, columns=4)
+        gallery.select(fn=on_gallery_img_select, inputs=[gallery_paths, user_data], outputs=user_data)
 
     # --- Screen 2: Colors ---
     with gr.Column(visible=False) as screen2:
@@ -252,8 +341,10 @@ with gr.Blocks(theme=gr.themes.Soft(), css="footer {display: none !important}")
 
                 # Add a button to apply the selected colors
                 apply_button = gr.Button("Apply Colors", variant="primary")
-                gstwp.configure_sync_task(apply_button, apply_colors, work_func_kwargs={},
-                                          gradio_blocks_to_interact={'inputs': [user_data, working_images], 'outputs': [working_images]})
+                task_events.append(gstwp.configure_sync_task(
+                    apply_button, apply_colors, work_func_kwargs={},
+                    gradio_blocks_to_interact={'inputs': [user_data, working_images], 'outputs': [working_images]},
+                    cancel_btn=cancel_button))
 
 
 
@@ -273,9 +364,13 @@ with gr.Blocks(theme=gr.themes.Soft(), css="footer {display: none !important}")
             eraser = None,
         )
         apply_edits_button = gr.Button("Apply Edits", variant="primary")
-        gstwp.configure_sync_task(apply_edits_button, apply_edits, work_func_kwargs={},
-                                  gradio_blocks_to_interact={'inputs': [drawing_canvas, user_data, working_images],
-                                                             'outputs': [working_images]})
+        task_events.append(gstwp.configure_sync_task(
+            apply_edits_button, apply_edits, work_func_kwargs={},
+            gradio_blocks_to_interact={'inputs': [drawing_canvas, user_data, working_images], 'outputs': [working_images]},
+            cancel_btn=cancel_button))
+
+    # One click handler for all the tasks, so a click cancels the session's job once
+    gstwp.configure_cancel(cancel_button, task_events)
 
 
     # --- Navigation Buttons ---
@@ -311,7 +406,13 @@ with gr.Blocks(theme=gr.themes.Soft(), css="footer {display: none !important}")
         inputs=None,
         outputs=[screen_index, user_data]
     )
+    demo.load(
+        fn=stream_gallery,
+        inputs=[gallery_paths],
+        outputs=[gallery]
+    )
 
 if __name__ == "__main__":
-    demo.launch(server_port=7861)
+    # Handlers of different sessions run concurrently, the job queue bounds the load on the backends
+    demo.queue(default_concurrency_limit=16).launch(server_port=7861)
 
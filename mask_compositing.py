@@ -0,0 +1,112 @@
+import numpy as np
+from PIL import ImageFilter
+
+
+def find_drawn_region(background, composite, chunk_rows=64):
+    """
+    Find the pixels drawn on an image editor canvas, by comparing its background and composite images.
+    The rows are compared in chunks from the top and from the bottom, so an untouched canvas exits after a cheap
+    scan, and the per-pixel comparison only runs on the band of rows that changed.
+
+    :param background: (H, W, C) uint8 array, the canvas background.
+    :param composite: (H, W, C) uint8 array, the background with the drawing.
+    :param chunk_rows: Number of rows compared at once.
+    :return: (bbox, mask) where bbox is (top, left, bottom, right), bottom/right exclusive, and mask is the
+             (bottom-top, right-left) bool array of the changed pixels inside it. None if nothing was drawn.
+    """
+    height = background.shape[0]
+    starts = range(0, height, chunk_rows)
+    top = next((start for start in starts
+                if not np.array_equal(background[start:start + chunk_rows], composite[start:start + chunk_rows])), None)
+    if top is None:
+        return None
+    bottom = next(start + chunk_rows for start in reversed(starts)
+                  if not np.array_equal(background[start:start + chunk_rows], composite[start:start + chunk_rows]))
+
+    band_mask = np.not_equal(background[top:bottom], composite[top:bottom])
+    band_mask = band_mask.any(axis=2) if band_mask.ndim == 3 else band_mask
+    rows = np.flatnonzero(band_mask.any(axis=1))
+    cols = np.flatnonzero(band_mask.any(axis=0))
+    bbox = (top + int(rows[0]), int(cols[0]), top + int(rows[-1]) + 1, int(cols[-1]) + 1)
+    return bbox, band_mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+
+def region_to_mask(shape, bbox, mask):
+    """
+    Expand a region found by find_drawn_region to a full frame black and white (0/255) uint8 mask.
+
+    :param shape: (H, W) of the full frame.
+    """
+    top, left, bottom, right = bbox
+    full_mask = np.zeros(shape[:2], dtype=np.uint8)
+    np.multiply(mask, np.uint8(255), out=full_mask[top:bottom, left:right], casting='unsafe')
+    return full_mask
+
+
+def apply_mask(image, mask):
+    """
+    Keep the pixels of an image where mask > 0 and zero the others, without leaving uint8.
+
+    :param image: (H, W, C) array or PIL image.
+    :param mask: (H, W) array.
+    :return: (H, W, C) uint8 array.
+    """
+    masked = np.array(image, dtype=np.uint8)  # A copy, so it can be masked in place
+    np.multiply(masked, (mask > 0)[:, :, None], out=masked, casting='unsafe')
+    return masked
+
+
+def mask_bbox(mask):
+    """
+    Bounding box (top, left, bottom, right) of the mask > 0 pixels, bottom/right exclusive. None for an empty mask.
+    """
+    mask = np.asarray(mask)
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1
+
+
+def roi_box(bbox, image_size, padding=32, min_size=128):
+    """
+    Region of interest around a mask bounding box: the box grown by padding on each side and to at least
+    min_size x min_size (for context), clamped to the image.
+
+    :param bbox: (top, left, bottom, right) as returned by mask_bbox.
+    :param image_size: (width, height) of the image.
+    :return: (left, top, right, bottom), the PIL crop box.
+    """
+    top, left, bottom, right = bbox
+    width, height = image_size
+
+    def grow(lo, hi, limit):
+        lo, hi = max(0, lo - padding), min(limit, hi + padding)
+        size = min(max(hi - lo, min_size), limit)
+        lo = min(max(0, lo - (size - (hi - lo)) // 2), limit - size)
+        return lo, lo + size
+
+    left, right = grow(left, right, width)
+    top, bottom = grow(top, bottom, height)
+    return left, top, right, bottom
+
+
+def feather_blend(base, patch, box, mask, feather=8):
+    """
+    Paste a rendered patch back into the full image, blending it in through the (dilated and blurred) mask so the
+    edges of the region do not show.
+
+    :param base: Full PIL image.
+    :param patch: PIL image of the rendered region, resized to the box if needed.
+    :param box: (left, top, right, bottom) of the region in base.
+    :param mask: PIL mask of the region (box size), white where the patch replaces base.
+    :param feather: Width in pixels of the blended edge.
+    :return: A new PIL image.
+    """
+    size = (box[2] - box[0], box[3] - box[1])
+    alpha = mask.convert('L').resize(size)
+    if feather > 0:
+        alpha = alpha.filter(ImageFilter.MaxFilter(2 * feather + 1)).filter(ImageFilter.GaussianBlur(feather / 2))
+    blended = base.convert('RGB')  # Always a copy
+    blended.paste(patch.convert('RGB').resize(size), box[:2], alpha)
+    return blended
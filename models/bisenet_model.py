@@ -6,6 +6,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 from models.resnet import Resnet18
 # from modules.bn import InPlaceABNSync as BatchNorm2d
@@ -25,7 +26,7 @@ class ConvBNReLU(nn.Module):
 
     def forward(self, x):
         x = self.conv(x)
-        x = F.relu(self.bn(x))
+        x = F.relu(self.bn(x), inplace=True)
         return x
 
     def init_weight(self):
@@ -34,6 +35,9 @@ class ConvBNReLU(nn.Module):
                 nn.init.kaiming_normal_(ly.weight, a=1)
                 if not ly.bias is None: nn.init.constant_(ly.bias, 0)
 
+    def fuse_for_inference(self):
+        self.conv, self.bn = fuse_conv_bn_eval(self.conv, self.bn), nn.Identity()
+
 class BiSeNetOutput(nn.Module):
     def __init__(self, in_chan, mid_chan, n_classes, *args, **kwargs):
         super(BiSeNetOutput, self).__init__()
@@ -52,6 +56,9 @@ class BiSeNetOutput(nn.Module):
                 nn.init.kaiming_normal_(ly.weight, a=1)
                 if not ly.bias is None: nn.init.constant_(ly.bias, 0)
 
+    def fuse_for_inference(self):
+        self.conv.fuse_for_inference()
+
     def get_params(self):
         wd_params, nowd_params = [], []
         for name, module in self.named_modules():
@@ -88,11 +95,15 @@ class AttentionRefinementModule(nn.Module):
                 nn.init.kaiming_normal_(ly.weight, a=1)
                 if not ly.bias is None: nn.init.constant_(ly.bias, 0)
 
+    def fuse_for_inference(self):
+        self.conv.fuse_for_inference()
+        self.conv_atten, self.bn_atten = fuse_conv_bn_eval(self.conv_atten, self.bn_atten), nn.Identity()
+
 
 class ContextPath(nn.Module):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, pretrained_backbone=True, *args, **kwargs):
         super(ContextPath, self).__init__()
-        self.resnet = Resnet18()
+        self.resnet = Resnet18(pretrained=pretrained_backbone)
         self.arm16 = AttentionRefinementModule(256, 128)
         self.arm32 = AttentionRefinementModule(512, 128)
         self.conv_head32 = ConvBNReLU(128, 128, ks=3, stride=1, padding=1)
@@ -130,6 +141,11 @@ class ContextPath(nn.Module):
                 nn.init.kaiming_normal_(ly.weight, a=1)
                 if not ly.bias is None: nn.init.constant_(ly.bias, 0)
 
+    def fuse_for_inference(self):
+        self.resnet.fuse_for_inference()
+        for module in (self.arm16, self.arm32, self.conv_head32, self.conv_head16, self.conv_avg):
+            module.fuse_for_inference()
+
     def get_params(self):
         wd_params, nowd_params = [], []
         for name, module in self.named_modules():
@@ -215,6 +231,9 @@ class FeatureFusionModule(nn.Module):
                 nn.init.kaiming_normal_(ly.weight, a=1)
                 if not ly.bias is None: nn.init.constant_(ly.bias, 0)
 
+    def fuse_for_inference(self):
+        self.convblk.fuse_for_inference()
+
     def get_params(self):
         wd_params, nowd_params = [], []
         for name, module in self.named_modules():
@@ -228,9 +247,13 @@ class FeatureFusionModule(nn.Module):
 
 
 class BiSeNet(nn.Module):
-    def __init__(self, n_classes, *args, **kwargs):
+    def __init__(self, n_classes, pretrained_backbone=True, *args, **kwargs):
+        """
+        :param pretrained_backbone: Load the ImageNet ResNet18 weights into the backbone. Set to False when a full
+                                    BiSeNet checkpoint is loaded right after construction, to avoid the download.
+        """
         super(BiSeNet, self).__init__()
-        self.cp = ContextPath()
+        self.cp = ContextPath(pretrained_backbone=pretrained_backbone)
         ## here self.sp is deleted
         self.ffm = FeatureFusionModule(256, 256)
         self.conv_out = BiSeNetOutput(256, 256, n_classes)
@@ -253,12 +276,40 @@ class BiSeNet(nn.Module):
         feat_out32 = F.interpolate(feat_out32, (H, W), mode='bilinear', align_corners=True)
         return feat_out, feat_out16, feat_out32
 
+    def forward_main(self, x, upsample=True):
+        """
+        Inference entry point: computes only the fused head (the first output of forward),
+        skipping the auxiliary conv_out16/conv_out32 heads that are only used for training.
+        With upsample=False the logits are returned at the 1/8 feature resolution.
+        """
+        H, W = x.size()[2:]
+        feat_res8, feat_cp8, _ = self.cp(x)
+        feat_fuse = self.ffm(feat_res8, feat_cp8)
+        feat_out = self.conv_out(feat_fuse)
+        if upsample:
+            feat_out = F.interpolate(feat_out, (H, W), mode='bilinear', align_corners=True)
+        return feat_out
+
     def init_weight(self):
         for ly in self.children():
             if isinstance(ly, nn.Conv2d):
                 nn.init.kaiming_normal_(ly.weight, a=1)
                 if not ly.bias is None: nn.init.constant_(ly.bias, 0)
 
+    def fuse_for_inference(self):
+        """
+        Fold every BatchNorm into its preceding convolution (ContextPath, ResNet layers, attention and fusion
+        modules and the output heads), removing a separate BatchNorm pass per layer. The ReLUs that follow run
+        in place on the convolution output.
+        The model must be in eval mode, and it can no longer be trained afterwards.
+        """
+        assert not self.training, "fuse_for_inference requires an eval-mode model"
+        self.cp.fuse_for_inference()
+        self.ffm.fuse_for_inference()
+        for head in (self.conv_out, self.conv_out16, self.conv_out32):
+            head.fuse_for_inference()
+        return self
+
     def get_params(self):
         wd_params, nowd_params, lr_mul_wd_params, lr_mul_nowd_params = [], [], [], []
         for name, child in self.named_children():
@@ -272,6 +323,19 @@ class BiSeNet(nn.Module):
         return wd_params, nowd_params, lr_mul_wd_params, lr_mul_nowd_params
 
 
+class BiSeNetInference(nn.Module):
+    """
+    Wraps a BiSeNet so that forward returns only the fused head logits at the 1/8 feature resolution.
+    This is the graph that gets traced to TorchScript (see export_bisenet.py), and the one HairMaskGenerator runs.
+    """
+    def __init__(self, bisenet):
+        super(BiSeNetInference, self).__init__()
+        self.bisenet = bisenet
+
+    def forward(self, x):
+        return self.bisenet.forward_main(x, upsample=False)
+
+
 if __name__ == "__main__":
     net = BiSeNet(19)
     net.cuda()
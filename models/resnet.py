@@ -5,6 +5,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.model_zoo as modelzoo
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 # from modules.bn import InPlaceABNSync as BatchNorm2d
 
@@ -35,7 +36,7 @@ class BasicBlock(nn.Module):
 
     def forward(self, x):
         residual = self.conv1(x)
-        residual = F.relu(self.bn1(residual))
+        residual = F.relu(self.bn1(residual), inplace=True)
         residual = self.conv2(residual)
         residual = self.bn2(residual)
 
@@ -47,6 +48,12 @@ class BasicBlock(nn.Module):
         out = self.relu(out)
         return out
 
+    def fuse_for_inference(self):
+        self.conv1, self.bn1 = fuse_conv_bn_eval(self.conv1, self.bn1), nn.Identity()
+        self.conv2, self.bn2 = fuse_conv_bn_eval(self.conv2, self.bn2), nn.Identity()
+        if self.downsample is not None:
+            self.downsample = fuse_conv_bn_eval(self.downsample[0], self.downsample[1])
+
 
 def create_layer_basic(in_chan, out_chan, bnum, stride=1):
     layers = [BasicBlock(in_chan, out_chan, stride=stride)]
@@ -56,7 +63,7 @@ def create_layer_basic(in_chan, out_chan, bnum, stride=1):
 
 
 class Resnet18(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
         super(Resnet18, self).__init__()
         self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3,
                                bias=False)
@@ -66,11 +73,12 @@ class Resnet18(nn.Module):
         self.layer2 = create_layer_basic(64, 128, bnum=2, stride=2)
         self.layer3 = create_layer_basic(128, 256, bnum=2, stride=2)
         self.layer4 = create_layer_basic(256, 512, bnum=2, stride=2)
-        self.init_weight()
+        if pretrained:
+            self.init_weight()
 
     def forward(self, x):
         x = self.conv1(x)
-        x = F.relu(self.bn1(x))
+        x = F.relu(self.bn1(x), inplace=True)
         x = self.maxpool(x)
 
         x = self.layer1(x)
@@ -87,6 +95,12 @@ class Resnet18(nn.Module):
             self_state_dict.update({k: v})
         self.load_state_dict(self_state_dict)
 
+    def fuse_for_inference(self):
+        self.conv1, self.bn1 = fuse_conv_bn_eval(self.conv1, self.bn1), nn.Identity()
+        for layer in (self.layer1, self.layer2, self.layer3, self.layer4):
+            for block in layer:
+                block.fuse_for_inference()
+
     def get_params(self):
         wd_params, nowd_params = [], []
         for name, module in self.named_modules():
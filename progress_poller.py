@@ -0,0 +1,63 @@
+import threading
+from contextlib import contextmanager
+
+
+class ProgressPoller:
+    """
+    Polls the progress of one backend from a single background thread and keeps the latest value, so any number of
+    sessions can read it without sending their own requests. Polling only runs while at least one job is tracked,
+    and the thread sleeps when the backend is idle.
+
+    Example usage:
+        poller = ProgressPoller(client.fetch_progress, interval=0.5)
+        with poller.track():
+            result = send_request()  # poller.progress is refreshed meanwhile
+    """
+    def __init__(self, fetch_fn, interval=0.5):
+        """
+        :param fetch_fn: Function returning the current progress of the backend (0-100).
+        :param interval: Seconds between polls while jobs are in flight.
+        """
+        self.fetch_fn = fetch_fn
+        self.interval = interval
+        self.progress = 0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    @contextmanager
+    def track(self):
+        """Context of a job running on the backend, the backend is polled while any job is tracked."""
+        with self._condition:
+            self._in_flight += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll_loop, name="a1111-progress-poller", daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+        try:
+            yield self
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                if not self._in_flight:
+                    self.progress = 0
+                self._condition.notify_all()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def _poll_loop(self):
+        while True:
+            with self._condition:
+                while not self._in_flight:
+                    self._condition.wait()
+            try:
+                progress = self.fetch_fn()
+            except Exception as e:
+                print(f"Warning: Progress poll failed: {e}")
+                progress = None
+            with self._condition:
+                if progress is not None and self._in_flight:
+                    self.progress = progress
+                self._condition.wait(self.interval)
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import time
+
+import torch
+from PIL import Image
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from hair_utils import HairMaskGenerator, mask_iou, select_quantized_engine
+from models.bisenet_model import BiSeNet, BiSeNetInference
+
+
+def load_images_from_folder(folder, limit=None):
+    """
+    Load the images of a local folder as RGB PIL images, sorted by file name.
+
+    :param folder: Folder containing .png/.jpg/.jpeg images.
+    :param limit: Maximum number of images to load (all if None).
+    """
+    filenames = sorted(f for f in os.listdir(folder) if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+    if limit:
+        filenames = filenames[:limit]
+    return [Image.open(os.path.join(folder, f)).convert("RGB") for f in filenames]
+
+
+def quantize_bisenet(model_path, calibration_images, output_path, engine=None, batch_size=8, resolution=512):
+    """
+    Statically quantize BiSeNet (ResNet18 backbone and the fused head) to INT8 with FX graph mode quantization,
+    calibrate it on local images and save it as a TorchScript artifact for HairMaskGenerator(quantized_model_path=...).
+
+    :param model_path: Path to the FP32 BiSeNet checkpoint.
+    :param calibration_images: List of PIL images used to collect activation ranges.
+    :param output_path: Path where the quantized TorchScript artifact will be saved.
+    :param engine: Quantized engine to target ('x86', 'fbgemm' or 'qnnpack'), the best available if None.
+    """
+    engine = engine or select_quantized_engine()
+    torch.backends.quantized.engine = engine
+
+    net = BiSeNet(n_classes=19, pretrained_backbone=False)
+    net.load_state_dict(torch.load(model_path, map_location='cpu'))
+    model = BiSeNetInference(net).eval()
+
+    # Reuse the generator preprocessing so calibration sees exactly what inference sees
+    to_tensor = HairMaskGenerator.preprocessing(resolution)
+    example_inputs = (torch.zeros(1, 3, resolution, resolution),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs)
+    with torch.no_grad():
+        for start in range(0, len(calibration_images), batch_size):
+            prepared(torch.stack([to_tensor(image) for image in calibration_images[start:start + batch_size]]))
+        quantized = convert_fx(prepared)
+        traced = torch.jit.freeze(torch.jit.trace(quantized, example_inputs))
+    torch.jit.save(traced, output_path, _extra_files={'quantized_engine': engine})
+    return output_path
+
+
+def compare_with_fp32(fp32_generator, quantized_generator, images, batch_size=8):
+    """
+    Compare the hair masks of the quantized model against the FP32 model and measure the throughput of both.
+
+    :return: dictionary with the per-image IoU statistics and masks per second of each model.
+    """
+    report = {'num_images': len(images), 'batch_size': batch_size}
+    masks = {}
+    for name, generator in (('fp32', fp32_generator), ('quantized', quantized_generator)):
+        generator.generate_hair_masks(images[:batch_size], batch_size=batch_size)  # warm-up
+        start = time.perf_counter()
+        masks[name] = generator.generate_hair_masks(images, batch_size=batch_size)
+        report[f'{name}_masks_per_sec'] = len(images) / (time.perf_counter() - start)
+
+    ious = [mask_iou(a, b) for a, b in zip(masks['fp32'], masks['quantized'])]
+    report['iou_mean'] = sum(ious) / len(ious)
+    report['iou_min'] = min(ious)
+    report['speedup'] = report['quantized_masks_per_sec'] / report['fp32_masks_per_sec']
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate an INT8 BiSeNet and compare it against the FP32 model.")
+    parser.add_argument("--images", required=True, help="Folder of local images used for calibration")
+    parser.add_argument("--eval-images", help="Folder of images for the comparison report (defaults to --images)")
+    parser.add_argument("--model", default="./models/79999_iter.pth", help="FP32 BiSeNet checkpoint")
+    parser.add_argument("--output", default="./models/79999_iter.int8.pt", help="Output quantized TorchScript file")
+    parser.add_argument("--report", help="Optional path of a JSON file for the comparison report")
+    parser.add_argument("--engine", choices=['x86', 'fbgemm', 'qnnpack'], help="Quantized engine to target")
+    parser.add_argument("--limit", type=int, default=100, help="Maximum number of images to load per folder")
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+
+    calibration_images = load_images_from_folder(args.images, args.limit)
+    print(f"Calibrating on {len(calibration_images)} images...")
+    quantize_bisenet(args.model, calibration_images, args.output, engine=args.engine, batch_size=args.batch_size)
+    print(f"Saved quantized model to {args.output}")
+
+    eval_images = load_images_from_folder(args.eval_images, args.limit) if args.eval_images else calibration_images
+    # The mask cache is disabled so the throughput numbers measure inference
+    report = compare_with_fp32(HairMaskGenerator(model_path=args.model, cache_max_bytes=0),
+                               HairMaskGenerator(quantized_model_path=args.output, cache_max_bytes=0),
+                               eval_images, batch_size=args.batch_size)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
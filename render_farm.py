@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from auto1111_if import color_modification
+from backend_pool import BackendPool
+from color_pallete import hair_color_dict
+from gallery_loader import GalleryLoader
+from hair_utils import HairMaskGenerator, image_digest
+from vers_image import VersImage
+
+
+class RenderStore:
+    """
+    Indexed store of precomputed recolor renders, keyed by the photo content (image_digest of the gallery
+    thumbnail) and the palette color code. Renders are written atomically as root/<photo key>/<color code>.png, so an
+    interrupted render farm resumes by skipping the existing files, and root/index.jsonl records each completed
+    render with its source photo.
+
+    Example usage:
+        store = RenderStore("./renders")
+        image = store.get(image_digest(photo), "7.1")  # None if it was not precomputed
+    """
+    def __init__(self, root):
+        self.root = root
+        self.index_path = os.path.join(root, "index.jsonl")
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, photo_key, color_code):
+        return os.path.join(self.root, photo_key, f"{color_code}.png")
+
+    def has(self, photo_key, color_code):
+        return os.path.exists(self.path(photo_key, color_code))
+
+    def get(self, photo_key, color_code):
+        """Returns the precomputed render as a PIL image, or None."""
+        try:
+            image = Image.open(self.path(photo_key, color_code))
+            image.load()
+            return image
+        except FileNotFoundError:
+            return None
+
+    def put(self, photo_key, color_code, image, source_path=None):
+        """
+        :param image: The render, a VersImage.
+        """
+        path = self.path(photo_key, color_code)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(image.to_streamio("PNG").getvalue())  # The backend's PNG bytes, without decoding them
+        os.replace(tmp_path, path)
+        with self._lock, open(self.index_path, "a") as f:
+            f.write(json.dumps({"photo": photo_key, "color": color_code, "path": path, "source": source_path}) + "\n")
+
+    def entries(self):
+        """Returns the index entries of the completed renders."""
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+def render_gallery(gallery_loader, hair_mask_generator, store, color_codes, client, seed, max_in_flight=2):
+    """
+    Render every gallery photo in every palette color into the store, skipping renders that already exist.
+    The hair mask is computed once per photo, and at most max_in_flight renders are submitted at a time.
+
+    :return: number of renders made.
+    """
+    slots = threading.BoundedSemaphore(max_in_flight)
+    rendered = []
+
+    def render(photo_key, source_path, photo, hair_mask, color_code):
+        try:
+            image = color_modification(VersImage.from_image(photo), VersImage.from_numpy(hair_mask),
+                                       hair_color_dict[color_code]["Name"], seed=seed, client=client)
+            if image is None:
+                print(f"Warning: No image returned for {source_path} in color {color_code}.")
+            else:
+                store.put(photo_key, color_code, image, source_path)
+                rendered.append((photo_key, color_code))
+                print(f"Rendered {source_path} in color {color_code}.")
+        except Exception as e:
+            print(f"Warning: Failed to render {source_path} in color {color_code}: {e}")
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for source_path in gallery_loader.list_image_paths():
+            photo = GalleryLoader.open_thumbnail(gallery_loader.thumbnail_path(source_path))
+            photo_key = image_digest(photo)
+            missing_codes = [code for code in color_codes if not store.has(photo_key, code)]
+            if not missing_codes:
+                continue
+            hair_mask = hair_mask_generator.generate_hair_mask(photo)
+            for color_code in missing_codes:
+                slots.acquire()  # bounds the pipeline, photos are not decoded ahead of the renders
+                executor.submit(render, photo_key, source_path, photo, hair_mask, color_code)
+    return len(rendered)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute the recolor renders of every gallery photo and palette color.")
+    parser.add_argument("--images", default="C:/Users/Lab/Downloads/my_pics", help="Gallery folder")
+    parser.add_argument("--store", default="./renders", help="Folder of the render store")
+    parser.add_argument("--backends", nargs="+", default=["http://127.0.0.1:7860"], help="Automatic1111 base URLs")
+    parser.add_argument("--colors", nargs="+", default=sorted(hair_color_dict), help="Palette color codes to render")
+    parser.add_argument("--seed", type=int, default=1234, help="Render seed, keep it equal to COLOR_SEED in main.py")
+    parser.add_argument("--max-in-flight", type=int, help="Concurrent renders (defaults to one per backend)")
+    args = parser.parse_args()
+
+    count = render_gallery(GalleryLoader(args.images), HairMaskGenerator(), RenderStore(args.store), args.colors,
+                           BackendPool(args.backends, health_check_interval=30), args.seed,
+                           max_in_flight=args.max_in_flight or len(args.backends))
+    print(f"Done, {count} new renders.")
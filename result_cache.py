@@ -0,0 +1,115 @@
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+
+from tiered_cache import TieredCache
+
+_INCOMPLETE = object()  # Result handed to the calls waiting for a render that must not be shared
+
+
+class Img2ImgResultCache:
+    """
+    Memoizes img2img responses keyed by a digest of the normalized payload, which includes the base64 encoded
+    source image and mask. Only payloads with a fixed seed are cached, since seed -1 asks for a new random render.
+    Identical requests that arrive while the first one is still rendering wait for its result instead of being
+    sent to the backend again (single flight).
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024, cache_dir=None, max_disk_bytes=None):
+        """
+        :param max_bytes: Memory budget of the cached responses.
+        :param cache_dir: Optional folder for an on-disk tier, kept across restarts.
+        :param max_disk_bytes: Maximum total size of the disk tier, unbounded if None.
+        """
+        self.cache = TieredCache(max_bytes, sizeof=len, cache_dir=cache_dir, max_disk_bytes=max_disk_bytes)
+        self._in_flight = {}  # key -> Future of the request being sent to the backend
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cacheable(payload):
+        return payload.get('seed', -1) != -1
+
+    @staticmethod
+    def payload_key(payload):
+        normalized = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    def get(self, payload):
+        """The cached response of payload, or None (without rendering it)."""
+        if not self.cacheable(payload):
+            return None
+        data = self.cache.get(self.payload_key(payload))
+        return json.loads(data) if data is not None else None
+
+    def get_or_compute(self, payload, compute_fn, is_complete=None):
+        """
+        Return the cached response of payload, or call compute_fn() to get it (once for concurrent identical calls).
+
+        :param is_complete: Optional is_complete(result), False for a result that must not be shared (e.g. the
+                            partial render of an interrupted job): it is not cached, and the calls waiting for it
+                            render the payload again instead (one of them leads the new render).
+        """
+        if not self.cacheable(payload):
+            return compute_fn()
+
+        key = self.payload_key(payload)
+        while True:
+            data = self.cache.get(key)
+            if data is not None:
+                return json.loads(data)
+
+            with self._lock:
+                future = self._in_flight.get(key)
+                is_leader = future is None
+                if is_leader:
+                    future = self._in_flight[key] = Future()
+            if is_leader:
+                break
+            result = future.result()
+            if result is not _INCOMPLETE:
+                return result
+
+        try:
+            result = compute_fn()
+        except Exception as e:
+            self._finish(key, future, exception=e)
+            raise
+        complete = is_complete is None or is_complete(result)
+        if result.get('images') and complete:  # failed and interrupted renders are not cached
+            self.cache.put(key, json.dumps(result).encode())
+        self._finish(key, future, result=result if complete else _INCOMPLETE)
+        return result
+
+    def _finish(self, key, future, result=None, exception=None):
+        # The in-flight entry is removed first, so waiting calls that retry do not find the finished future again
+        with self._lock:
+            del self._in_flight[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+class CachingClient:
+    """
+    Puts an Img2ImgResultCache in front of an Auto1111Client or BackendPool, keeping the same interface.
+
+    Example usage:
+        set_default_client(CachingClient(BackendPool(urls), Img2ImgResultCache(cache_dir="./cache/renders")))
+    """
+    def __init__(self, client, result_cache):
+        self.client = client
+        self.result_cache = result_cache
+
+    def img2img(self, payload, job=None):
+        return self.result_cache.get_or_compute(payload, lambda: self.client.img2img(payload, job=job),
+                                                is_complete=lambda result: job is None or not job.interrupted)
+
+    def get_progress(self, job=None):
+        return job.get_progress() if job is not None else self.client.get_progress()
+
+    def interrupt(self, job=None):
+        return job.interrupt() if job is not None else self.client.interrupt()
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,141 @@
+import base64
+import contextlib
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from auto1111_if import Auto1111Client, Img2ImgJob, color_modification, get_progress, cancell_process
+from backend_pool import BackendPool
+from vers_image import VersImage
+
+
+# Stub Automatic1111 servers: img2img answers with a plain image after a delay, progress reports a fixed value.
+# Like A1111, a serial stub renders one request at a time, the others wait on the server.
+def start_stub_server(name, progress, delay=0.5, serial=False):
+    calls = {'img2img': 0, 'progress': 0, 'interrupt': 0}
+    render_lock = threading.Lock() if serial else contextlib.nullcontext()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, data):
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            calls['progress'] += 1
+            self.send_json({'progress': progress, 'name': name})
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path.endswith('/img2img'):
+                with render_lock:
+                    calls['img2img'] += 1
+                    time.sleep(delay)
+                img_byte_arr = io.BytesIO()
+                Image.new('RGB', (512, 512), 'red').save(img_byte_arr, format='PNG')
+                self.send_json({'images': [base64.b64encode(img_byte_arr.getvalue()).decode()]})
+            else:
+                calls['interrupt'] += 1
+                self.send_json({})
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, calls
+
+
+server_a, calls_a = start_stub_server("a", progress=0.25)
+server_b, calls_b = start_stub_server("b", progress=0.75)
+pool = BackendPool([f"http://127.0.0.1:{server_a.server_port}",
+                    f"http://127.0.0.1:{server_b.server_port}",
+                    "http://127.0.0.1:1"],  # nothing listens there
+                   retries=0)
+
+print("Healthy backends:", [backend.base_url for backend in pool.check_health()])
+
+# Least outstanding requests: 4 concurrent jobs are split between the two healthy backends
+source = VersImage.from_image(Image.new('RGB', (512, 512), 'white'))
+mask = VersImage.from_image(Image.new('L', (512, 512), 255))
+jobs = [Img2ImgJob() for _ in range(4)]
+threads = [threading.Thread(target=color_modification, args=(source, mask, "Ash Blonde"),
+                            kwargs={'client': pool, 'job': job}) for job in jobs]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+print("img2img calls per backend:", calls_a['img2img'], calls_b['img2img'])
+assert calls_a['img2img'] == 2 and calls_b['img2img'] == 2
+
+# Progress and interrupt go to the backend that owns the job, read while the job is still rendering
+progress_calls_before = calls_a['progress'], calls_b['progress']
+job = Img2ImgJob()
+thread = threading.Thread(target=color_modification, args=(source, mask, "Ash Blonde"),
+                          kwargs={'client': pool, 'job': job})
+thread.start()
+deadline = time.time() + 0.4  # Well before the stub's img2img delay ends
+while get_progress(job=job) == 0 and time.time() < deadline:
+    time.sleep(0.01)
+progress = get_progress(job=job)
+owner_is_a = job.client is pool.backends[0].client
+owner_calls, other_calls = (calls_a, calls_b) if owner_is_a else (calls_b, calls_a)
+other_calls_before = progress_calls_before[1] if owner_is_a else progress_calls_before[0]
+print("Progress of the running job:", progress, "- owner:", job.client.base_url)
+assert progress == (25 if owner_is_a else 75)
+assert other_calls['progress'] == other_calls_before
+cancell_process(job=job)
+thread.join()
+assert owner_calls['interrupt'] == 1 and calls_a['interrupt'] + calls_b['interrupt'] == 1
+
+# Failover: with a dead backend first in line, the job still completes on a live one
+pool.backends[2].healthy = True
+pool.backends[0].outstanding = pool.backends[1].outstanding = 1
+job = Img2ImgJob()
+result = color_modification(source, mask, "Ash Blonde", client=pool, job=job)
+print("Failover result:", result.image.size, "from", job.client.base_url, "- dead backend healthy:",
+      pool.backends[2].healthy)
+assert result is not None and not pool.backends[2].healthy
+
+# One backend, two jobs: the second one waits on the client side, cancelling it does not interrupt the first one
+server_c, calls_c = start_stub_server("c", progress=0.5, serial=True)
+client = Auto1111Client(f"http://127.0.0.1:{server_c.server_port}", retries=0)
+rendering_job, waiting_job = Img2ImgJob(), Img2ImgJob()
+results = {}
+threads = [threading.Thread(target=lambda j=j: results.__setitem__(j, color_modification(
+    source, mask, "Ash Blonde", client=client, job=j))) for j in (rendering_job, waiting_job)]
+threads[0].start()
+while calls_c['img2img'] == 0:
+    time.sleep(0.01)
+threads[1].start()
+while waiting_job.client is None:
+    time.sleep(0.01)
+print("Progress of the waiting job:", get_progress(job=waiting_job))
+assert get_progress(job=waiting_job) == 0
+cancell_process(job=waiting_job)
+threads[1].join(0.3)  # Woken up without waiting for the render ahead of it
+assert not threads[1].is_alive() and results[waiting_job] is None
+threads[0].join()
+print("Interrupts:", calls_c['interrupt'], "- img2img calls:", calls_c['img2img'])
+assert calls_c['interrupt'] == 0 and calls_c['img2img'] == 1 and results[rendering_job] is not None
+
+# Cancelling the job holding the backend does interrupt it
+job = Img2ImgJob()
+thread = threading.Thread(target=color_modification, args=(source, mask, "Ash Blonde"),
+                          kwargs={'client': client, 'job': job})
+thread.start()
+while calls_c['img2img'] == 1:
+    time.sleep(0.01)
+cancell_process(job=job)
+thread.join()
+assert calls_c['interrupt'] == 1
+print("Done")
@@ -0,0 +1,133 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from job_queue import JobCancelled, JobQueue, JobSuperseded, QueuedJob
+
+run_order = []
+
+
+def make_work(name, gate=None):
+    """Work function recording its name when it starts, then waiting for gate (if any)."""
+    def work(job):
+        run_order.append(name)
+        if gate is not None:
+            gate.wait(5)
+        return name
+    return work
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+# Round robin: with the worker busy, the queued jobs of three sessions are dispatched one session at a time
+queue = JobQueue(max_in_flight=1)
+gate = threading.Event()
+blocker = queue.submit("x", make_work("x", gate))
+wait_until(lambda: blocker.status == QueuedJob.RUNNING)
+jobs = {}
+for session_id, count in (("a", 3), ("b", 2), ("c", 1)):
+    for i in range(1, count + 1):
+        name = f"{session_id}{i}"
+        jobs[name] = queue.submit(session_id, make_work(name), supersede=False)
+positions = {name: queue.position(job) for name, job in jobs.items()}
+print("Positions:", positions)
+assert positions == {"a1": 0, "b1": 1, "c1": 2, "a2": 3, "b2": 4, "a3": 5}
+gate.set()
+for job in jobs.values():
+    job.future.result(5)
+print("Run order:", run_order)
+assert run_order == ["x", "a1", "b1", "c1", "a2", "b2", "a3"]
+
+# A session that was just served goes after a session that queued later
+run_order.clear()
+gate = threading.Event()
+a1 = queue.submit("a", make_work("a1", gate))
+wait_until(lambda: a1.status == QueuedJob.RUNNING)
+a2 = queue.submit("a", make_work("a2"), supersede=False)
+b1 = queue.submit("b", make_work("b1"))
+assert queue.position(b1) == 0 and queue.position(a2) == 1
+gate.set()
+a2.future.result(5)
+print("Run order:", run_order)
+assert run_order == ["a1", "b1", "a2"]
+
+# max_in_flight bounds the running jobs, max_in_flight_per_session the running jobs of one session
+queue = JobQueue(max_in_flight=2, max_in_flight_per_session=1)
+running, peak, peak_a = {}, [0], [0]
+lock = threading.Lock()
+
+
+def counted_work(job):
+    with lock:
+        running[job.session_id] = running.get(job.session_id, 0) + 1
+        peak[0] = max(peak[0], sum(running.values()))
+        peak_a[0] = max(peak_a[0], running.get("a", 0))
+    time.sleep(0.1)
+    with lock:
+        running[job.session_id] -= 1
+
+
+submitted = [queue.submit(session_id, counted_work, supersede=False) for session_id in "aaabbc"]
+for job in submitted:
+    job.future.result(5)
+print("Peak running jobs:", peak[0], "- of session a:", peak_a[0])
+assert peak[0] == 2 and peak_a[0] == 1
+
+# Supersede: a newer job of the session drops its queued one, other sessions are not affected
+queue = JobQueue(max_in_flight=1)
+gate = threading.Event()
+blocker = queue.submit("x", make_work("x", gate))
+wait_until(lambda: blocker.status == QueuedJob.RUNNING)
+stale = queue.submit("a", make_work("stale"))
+fresh = queue.submit("a", make_work("fresh"))
+try:
+    stale.future.result(5)
+    assert False, "The stale job should have been superseded"
+except JobSuperseded:
+    pass
+assert stale.status == QueuedJob.SUPERSEDED and queue.active_job("a") is fresh
+gate.set()
+assert fresh.future.result(5) == "fresh" and blocker.future.result(5) == "x"
+
+
+# Cancel: the running job is interrupted on its backend and raises JobCancelled, the queued one is dropped
+class StubClient:
+    def __init__(self):
+        self.interrupts = 0
+        self.interrupted = threading.Event()
+
+    def interrupt(self, job=None):
+        self.interrupts += 1
+        self.interrupted.set()
+        return SimpleNamespace(status_code=200)
+
+
+client = StubClient()
+
+
+def backend_work(job):
+    job.client = client
+    client.interrupted.wait(5)
+    return {'images': ['partial render']}
+
+
+queue = JobQueue(max_in_flight=1)
+running_job = queue.submit("a", backend_work)
+wait_until(lambda: running_job.client is client)  # Running on the stub backend
+queued_job = queue.submit("a", make_work("queued"), supersede=False)
+queue.cancel("a")
+queue.cancel("a")  # A second click does not interrupt the backend again
+for job, expected in ((running_job, JobCancelled), (queued_job, JobSuperseded)):
+    try:
+        job.future.result(5)
+        assert False, "The job should have been cancelled"
+    except JobSuperseded as e:
+        assert type(e) is expected
+print("Backend interrupts:", client.interrupts)
+assert client.interrupts == 1 and queue.active_job("a") is None
+print("Done")
@@ -0,0 +1,124 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class TieredCache:
+    """
+    Thread-safe LRU cache bounded by the total size in bytes of its values, with an optional on-disk tier.
+    Values evicted from memory stay on disk (when a cache_dir is given) and are promoted back on the next hit.
+
+    Example usage:
+        cache = TieredCache(max_bytes=64 * 1024 * 1024, sizeof=len)
+        cache.put("key", b"value")
+        value = cache.get("key")
+    """
+    def __init__(self, max_bytes, sizeof=len, cache_dir=None, dump=None, load=None, max_disk_bytes=None):
+        """
+        :param max_bytes: Maximum total size of the values kept in memory.
+        :param sizeof: Function returning the size in bytes of a value.
+        :param cache_dir: Folder of the on-disk tier, None to keep the cache in memory only.
+        :param dump: Function serializing a value to bytes for the disk tier (values must be bytes if None).
+        :param load: Function deserializing bytes read from the disk tier (bytes are returned as is if None).
+        :param max_disk_bytes: Maximum total size of the disk tier, unbounded if None.
+        """
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.cache_dir = cache_dir
+        self.dump = dump or (lambda value: value)
+        self.load = load or (lambda data: data)
+        self.max_disk_bytes = max_disk_bytes
+
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # key -> (value, size), least recently used first
+        self._bytes = 0
+        self._disk_bytes = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key][0]
+
+        if self.cache_dir:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    value = self.load(f.read())
+                os.utime(path)  # keeps the disk tier eviction least-recently-used
+            except FileNotFoundError:
+                return default
+            self._put_memory(key, value)
+            return value
+        return default
+
+    def put(self, key, value):
+        self._put_memory(key, value)
+        if self.cache_dir:
+            self._put_disk(key, value)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._items:
+                return True
+        return bool(self.cache_dir) and os.path.exists(self._path(key))
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _put_memory(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._items[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def _put_disk(self, key, value):
+        data = self.dump(value)
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        with self._lock:
+            if os.path.exists(path):
+                self._disk_bytes -= os.path.getsize(path)
+            os.replace(tmp_path, path)
+            self._disk_bytes += len(data)
+            if self.max_disk_bytes is not None and self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        # Oldest files first, until the disk tier is back under its limit
+        entries = sorted((entry for entry in os.scandir(self.cache_dir)
+                          if entry.is_file() and not entry.name.endswith('.tmp')),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._disk_bytes -= size
@@ -4,13 +4,34 @@ from PyQt5.QtGui import QImage, QPixmap
 import io
 
 class VersImage():
+    """
+    Image wrapper used across the UI and the Automatic1111 calls. An image created from encoded bytes keeps them and
+    is only decoded when its pixels are used, encodings and resizes are memoized, and to_streamio returns the
+    original bytes when they are already in the requested format.
+    """
     def __init__(self, filename = None):
         super().__init__()
         self.filename = filename
-        self.image = None
+        self._image = None
+        self._binary = None  # Original encoded bytes of the image, decoded on demand
+        self._encoded = {}  # (format, mode, options) -> encoded bytes
+        self._resized = {}  # resolution -> resized VersImage
         if filename:
             self.image = Image.open(filename)
 
+    @property
+    def image(self):
+        if self._image is None and self._binary is not None:
+            self._image = Image.open(io.BytesIO(self._binary))  # Reads the header, pixels are decoded on first use
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self._binary = None
+        self._encoded = {}
+        self._resized = {}
+
     @classmethod
     def open(cls, filename):
         obj = cls()
@@ -33,10 +54,7 @@ class VersImage():
     @classmethod
     def from_binary(cls, binary_data):
         obj = cls()
-        # Wrap it in a BytesIO buffer
-        img_stream = io.BytesIO(binary_data)
-        # Open as a PIL Image
-        obj.image = Image.open(img_stream)
+        obj._binary = bytes(binary_data)
         return obj
 
     def to_qimage(self, resolution = None):
@@ -79,16 +97,43 @@ class VersImage():
         result = Image.alpha_composite(background, overlay)
         return VersImage.from_image(result)
 
-    def to_streamio(self, format='PNG'):
-        img_byte_arr = io.BytesIO()
-        self.image.save(img_byte_arr, format=format)
+    def to_streamio(self, format='PNG', mode=None, **options):
+        """
+        Encode the image, e.g. to_streamio('PNG', compress_level=1) or to_streamio('PNG', mode='1') for a 1-bit mask.
+        The encoded bytes are cached per (format, mode, options), so sending the same image again does not re-encode.
 
-        # Move to beginning of the stream
-        img_byte_arr.seek(0)
-        return img_byte_arr
+        :param format: PIL format name.
+        :param mode: Optional PIL mode to convert to before encoding.
+        :param options: PIL save options of the format.
+        """
+        key = (format, mode, tuple(sorted(options.items())))
+        data = self._encoded.get(key)
+        if data is None:
+            if self._binary is not None and mode is None and self.image.format == format:
+                # Already encoded in this format, the save options only tune the encoder
+                data = self._binary
+            else:
+                image = self.image
+                if mode == '1':
+                    # Threshold rather than dither, masks must stay solid
+                    image = image.convert('L').point(lambda v: 255 if v >= 128 else 0, mode='1')
+                elif mode:
+                    image = image.convert(mode)
+                img_byte_arr = io.BytesIO()
+                image.save(img_byte_arr, format=format, **options)
+                data = img_byte_arr.getvalue()
+            self._encoded[key] = data
+        return io.BytesIO(data)
 
     def resize(self, resolution):
-        return VersImage.from_image(self.image.resize(resolution))
+        resolution = tuple(resolution)
+        if self.image.size == resolution:
+            return self
+        # The resized images are cached too, so they keep their encoded bytes between requests
+        resized = self._resized.get(resolution)
+        if resized is None:
+            resized = self._resized[resolution] = VersImage.from_image(self.image.resize(resolution))
+        return resized
 
     def to_pil(self):
         return self.image
\ No newline at end of file